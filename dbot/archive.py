@@ -0,0 +1,77 @@
+import datetime
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+__all__ = ["ArchiveEntry", "Recorder", "read_archive"]
+
+logger = logging.getLogger("discord_bot")
+
+
+class ArchiveEntry(NamedTuple):
+    timestamp: float
+    # "campaigns" or "rss"
+    kind: str
+    # Country ID for RSS feeds
+    key: str
+    body: bytes
+
+
+def _member_name(entry: ArchiveEntry) -> str:
+    return f"{entry.kind}/{int(entry.timestamp * 1000):013d}-{entry.key}"
+
+
+def _parse_member_name(name: str) -> ArchiveEntry:
+    kind, _, rest = name.partition("/")
+    ts, _, key = rest.partition("-")
+    return ArchiveEntry(int(ts) / 1000, kind, key, b"")
+
+
+class Recorder:
+    """Save fetched payloads to a deflate-compressed zip archive, one member per payload.
+
+    Archive is named after the time recording started, members are named `<kind>/<timestamp ms>-<key>`.
+    Compressing and writing happens on a single background thread so the event loop is never blocked.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"recording-{datetime.datetime.now():%Y%m%d-%H%M%S}.zip")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+
+    def record(self, kind: str, key: str, body: bytes, timestamp: Optional[float] = None) -> Future:
+        """Queue payload for writing
+
+        :param kind: str Payload kind - "campaigns" or "rss"
+        :param key: str Payload key, eg. country ID
+        :param body: bytes Raw response body
+        :param timestamp: float Time payload was fetched, defaults to now
+        """
+        entry = ArchiveEntry(time.time() if timestamp is None else timestamp, kind, str(key), body)
+        future = self._executor.submit(self._write, entry)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _write(self, entry: ArchiveEntry):
+        with zipfile.ZipFile(self.path, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(_member_name(entry), entry.body)
+
+    def _log_failure(self, future: Future):
+        if future.exception() is not None:
+            logger.error(f"Unable to record payload to {self.path}", exc_info=future.exception())
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def read_archive(path: str) -> List[ArchiveEntry]:
+    """Read every recorded payload ordered by the time it was fetched"""
+    entries = []
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            entries.append(_parse_member_name(name)._replace(body=archive.read(name)))
+    entries.sort(key=lambda entry: (entry.timestamp, entry.kind, entry.key))
+    return entries
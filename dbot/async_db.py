@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dbot.db import DiscordDB, connect
+
+__all__ = ["AsyncDiscordDB"]
+
+logger = logging.getLogger("discord_bot")
+
+# (method name, args, kwargs, loop, future)
+Job = Tuple[str, Tuple[Any, ...], Dict[str, Any], asyncio.AbstractEventLoop, asyncio.Future]
+
+
+class _BatchConnection(sqlite3.Connection):
+    """Connection whose `with conn:` blocks don't commit while a batch runs, so the whole batch is a single transaction"""
+
+    batching = False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.batching:
+            return False
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+
+def _resolve(future: asyncio.Future, result: Any, ok: bool):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(result)
+    else:
+        future.set_exception(result)
+
+
+class AsyncDiscordDB:
+    """Asyncio facade over DiscordDB which never touches the database on the event loop thread.
+
+    * Writes are queued to a single writer thread, which runs everything queued so far in one transaction (every call
+      in its own savepoint, so a failing call doesn't affect the others). Awaiting a write returns after the commit.
+    * Reads run in a thread pool, every thread with its own read-only connection. The database is switched to WAL
+      mode, so reads don't wait for the writer. In-memory databases can't be shared between connections, so there
+      reads are queued to the writer too.
+    * Notification channel/role lookups are served from the writer's in-memory cache without leaving the loop.
+
+    Every public DiscordDB method is available as a coroutine function with the same signature.
+    """
+
+    READS = frozenset(
+        (
+            "get_player",
+            "get_member",
+            "check_epic",
+            "check_empty_medal",
+            "get_unseen_epics",
+            "get_unseen_empty_medals",
+            "get_rss_feed_timestamp",
+            "get_notification_channel_id",
+            "get_battle_order",
+        )
+    )
+    CACHED = frozenset(("get_kind_notification_channel_ids", "get_role_id_for_channel_division"))
+    WRITES = frozenset(
+        (
+            "add_player",
+            "update_player",
+            "add_member",
+            "update_member",
+            "add_epic",
+            "add_empty_medal",
+            "add_epics",
+            "add_empty_medals",
+            "touch_divisions",
+            "prune_divisions",
+            "set_rss_feed_timestamp",
+            "add_notification_channel",
+            "remove_kind_notification_channel",
+            "add_role_mapping_entry",
+            "remove_all_channel_role_mappings",
+            "remove_role_mapping",
+            "set_battle_order",
+            "delete_battle_order",
+        )
+    )
+
+    def __init__(self, db_name: str = "", vacuum: bool = False, read_workers: int = 4, max_batch: int = 100, batch_window: float = 0.002):
+        """
+        :param db_name: str Database file, empty or `:memory:` for an in-memory database
+        :param vacuum: bool Rebuild database file after migrations
+        :param read_workers: int Threads running reads
+        :param max_batch: int Maximum number of writes committed in one transaction
+        :param batch_window: float Seconds to wait for more writes after the first one before committing
+        """
+        self.db_name = db_name
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.in_memory = db_name in ("", ":memory:")
+        self.batches = 0
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self._writer_db: Optional[DiscordDB] = None
+        self._writer_error: Optional[BaseException] = None
+        ready = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, args=(vacuum, ready), name="db-writer", daemon=True)
+        self._writer.start()
+        ready.wait()
+        if self._writer_error is not None:
+            raise self._writer_error
+        self._local = threading.local()
+        self._readers = None if self.in_memory else ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-read")
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        if name in self.CACHED:
+            method = getattr(self._writer_db, name)
+
+            async def cached(*args, **kwargs):
+                return method(*args, **kwargs)
+
+            return cached
+        if name in self.WRITES or (name in self.READS and self._readers is None):
+            return lambda *args, **kwargs: self._submit(name, args, kwargs)
+        if name in self.READS:
+            return lambda *args, **kwargs: asyncio.get_event_loop().run_in_executor(self._readers, lambda: getattr(self._reader(), name)(*args, **kwargs))
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def _submit(self, name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put((name, args, kwargs, loop, future))
+        return future
+
+    def _reader(self) -> DiscordDB:
+        if not hasattr(self._local, "db"):
+            conn = connect(self.db_name)
+            self._local.db = DiscordDB(conn)
+            conn.execute("PRAGMA query_only = ON")
+        return self._local.db
+
+    def _write_loop(self, vacuum: bool, ready: threading.Event):
+        try:
+            conn = connect(self.db_name, factory=_BatchConnection)
+            self._writer_db = DiscordDB(conn, vacuum=vacuum)
+            self._writer_db.defer_cache_refresh = True
+        except BaseException as e:
+            self._writer_error = e
+            return
+        finally:
+            ready.set()
+
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            try:
+                self._run_batch(conn, batch)
+            except Exception as e:
+                # Keep the writer alive, otherwise every later write would wait forever
+                logger.error(f"Database writer failed to run a batch of {len(batch)} writes", exc_info=e)
+                self._resolve_batch(batch, [(e, False)] * len(batch))
+        conn.close()
+
+    def _run_batch(self, conn: _BatchConnection, batch: List[Job]):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.batching = True
+            for name, args, kwargs, loop, future in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = getattr(self._writer_db, name)(*args, **kwargs)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    results.append((e, False))
+                else:
+                    results.append((result, True))
+                conn.execute("RELEASE job")
+            conn.batching = False
+            conn.commit()
+        except Exception as e:
+            conn.batching = False
+            if conn.in_transaction:
+                conn.rollback()
+            logger.error(f"Database batch of {len(batch)} writes failed", exc_info=e)
+            results = [(e, False)] * len(batch)
+        # Notification channels are cached only once the batch is committed or rolled back, jobs rolled back to their
+        # savepoint may have touched the tables too
+        try:
+            self._writer_db.sync_notification_cache()
+        except Exception as e:
+            # Stays stale, so the next batch retries
+            logger.error("Unable to reload notification channel cache", exc_info=e)
+        self.batches += 1
+        self._resolve_batch(batch, results)
+
+    @staticmethod
+    def _resolve_batch(batch: List[Job], results: List[Tuple[Any, bool]]):
+        for (_, _, _, loop, future), (result, ok) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, result, ok)
+            except RuntimeError:
+                # The caller's event loop is already closed, nobody is waiting for the result
+                pass
+
+    def close(self):
+        """Finish queued writes and close all connections"""
+        self._queue.put(None)
+        self._writer.join()
+        if self._readers is not None:
+            self._readers.shutdown(wait=True)
@@ -2,7 +2,10 @@ import logging
 import os
 import sys
 
-from db import DiscordDB
+from archive import Recorder
+from async_db import AsyncDiscordDB
+from fetcher import Fetcher
+from loop_monitor import LoopMonitor
 
 APP_NAME = "discord_bot"
 
@@ -27,8 +30,32 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DEFAULT_CHANNEL_ID = os.getenv("DEFAULT_CHANNEL_ID", 603527159109124096)
 ADMIN_ID = os.getenv("ADMIN_ID", 220849530730577920)
 DB_NAME = os.getenv("DB_NAME", "discord.db")
+DB_VACUUM = bool(os.getenv("DB_VACUUM"))
 PRODUCTION = bool(os.getenv("PRODUCTION"))
-DB = DiscordDB(DB_NAME)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 20))
+# All feeds are on www.erepublik.com, so RSS_PER_HOST is the effective limit whenever it's lower than RSS_CONCURRENCY
+RSS_CONCURRENCY = int(os.getenv("RSS_CONCURRENCY", 10))
+RSS_PER_HOST = int(os.getenv("RSS_PER_HOST", 10))
+RSS_HOST_DELAY = float(os.getenv("RSS_HOST_DELAY", 0.05))
+# RSS feeds of countries with more events are polled more often, all feeds together at most RSS_REQUESTS_PER_MINUTE times a minute
+RSS_REQUESTS_PER_MINUTE = float(os.getenv("RSS_REQUESTS_PER_MINUTE", 8))
+RSS_MIN_INTERVAL = float(os.getenv("RSS_MIN_INTERVAL", 60))
+RSS_MAX_INTERVAL = float(os.getenv("RSS_MAX_INTERVAL", 30 * 60))
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 16))
+# "immediate" sends every notification right away, "digest" merges notifications per channel arriving within DIGEST_WINDOW seconds
+NOTIFICATION_MODE = os.getenv("NOTIFICATION_MODE", "immediate")
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", 30))
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics, port 0 disables the endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# Event loop blocked for longer than LOOP_STALL_THRESHOLD seconds gets its stack captured, see `!control loop`
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.5))
+# Directory to save every fetched campaignsJson and RSS payload to, for replaying with `python -m dbot.replay`
+RECORD_DIR = os.getenv("RECORD_DIR")
+DB = AsyncDiscordDB(DB_NAME, vacuum=DB_VACUUM)
+HTTP = Fetcher(timeout=HTTP_TIMEOUT)
+RECORDER = Recorder(RECORD_DIR) if RECORD_DIR else None
+LOOP_MONITOR = LoopMonitor(threshold=LOOP_STALL_THRESHOLD)
 
 
 MENTION_MAPPING = {1: "D1", 2: "D2", 3: "D3", 4: "D4", 11: "Air"}
@@ -42,6 +69,7 @@ NOTIFICATION_KINDS = (
 
 MESSAGES = dict(
     not_admin="❌ Only server administrators are allowed to enable notifications!",
+    not_bot_admin="❌ Only the bot's administrator is allowed to use this command!",
     not_in_pm="❌ Unable to notify in PMs!",
     command_failed="❌ Command failed!",
     only_registered_channels="❌ This command is only available from registered channels!",
@@ -0,0 +1,416 @@
+"""Benchmarks for the bot's hot paths against synthetic payloads of several sizes and recorded payloads
+
+Usage: python -m dbot.benchmark [benchmark ...] [--sizes small,large,huge] [--archive RECORDING] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import email.utils
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from operator import itemgetter
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+from erepublik.constants import COUNTRIES
+
+from dbot.archive import read_archive
+from dbot.classifier import EventClassifier
+from dbot.constants import UTF_FLAG, DivisionData, EventKind, events
+from dbot.db import DiscordDB
+from dbot.dispatch import NotificationDispatcher
+from dbot.rss import new_feed_entries
+from dbot.snapshot import ColumnarSnapshot, parse_campaigns, s_to_human
+
+SAMPLE_MESSAGES = [
+    "Russia attacked Vidzeme, Latvia",
+    "Vidzeme was secured by Latvia in the war versus Russia",
+    "Kurzeme was conquered by Russia in the war versus Latvia",
+    "Latvia declared war on Lithuania",
+    "President of Latvia proposed a war declaration against Estonia",
+    "The proposal for declaring war against Estonia was rejected.",
+    "President of Latvia proposed an alliance with Poland",
+    "Latvia signed an alliance with Poland",
+    "The alliance between Latvia and Poland was rejected",
+    "President of Latvia proposed an airstrike against Russia",
+    "Latvia prepares an airstrike on Russia",
+    "The airstrike on Russia was rejected",
+    "Latvia has declared Russia as a Natural Enemy",
+    "Russia has been proposed as Natural Enemy",
+    "Russia as new Natural Enemy proposal has been rejected",
+    "Russia is no longer a Natural Enemy for Latvia",
+    "Latvia no longer has a Natural Enemy",
+    "No Natural Enemy law has been proposed.",
+    "President of Latvia proposed a peace in the war against Russia",
+    "Latvia signed a peace treaty with Russia",
+    "The proposed peace treaty between Latvia and Russia was rejected",
+    "President of Latvia proposed to stop the trade with Russia",
+    "Latvia stopped trading with Russia",
+    "A congress donation to Plato was proposed",
+    "Latvia made a donation to Plato",
+    "A resistance has started in Vidzeme",
+    "A president impeachment against Plato was proposed",
+    "A new minimum wage was proposed",
+    "Latvia now has a new Work Tax",
+    "Taxes for Food changed",
+    "New taxes for Weapons were proposed",
+    "President of Latvia proposed a new welcome message for new citizens",
+    "Something nobody has a regex for",
+]
+
+
+def linear_classify(msg: str) -> Optional[Tuple[EventKind, Dict[str, Optional[str]]]]:
+    """Reference implementation - test every EventKind one after another"""
+    for kind in events:
+        match = kind.regex.search(msg)
+        if match:
+            return kind, match.groupdict()
+    return None
+
+
+def synthetic_battles(battles: int, now: int = None, seed: int = 0) -> Dict[str, Dict[str, Any]]:
+    """campaignsJson-like battles with every division in a random state"""
+    rnd = random.Random(seed)
+    now = now or int(time.time())
+    countries = list(UTF_FLAG)
+    battle_json = {}
+    div_id = 1
+    for battle_id in range(1, battles + 1):
+        invader, defender = rnd.sample(countries, 2)
+        divisions = {}
+        for division in (1, 2, 3, 4, 11):
+            wall_for = rnd.choice((invader, defender))
+            divisions[str(div_id)] = dict(
+                id=div_id,
+                div=division,
+                end=rnd.random() < 0.1 and now or None,
+                epic=rnd.choices((0, 1, 2, 3), (80, 10, 7, 3))[0],
+                intensity_scale=rnd.choice(("local", "cold_war", "full_scale", "world_war")),
+                wall={"for": wall_for, "dom": rnd.choices((50, 100, round(rnd.uniform(50, 66.7), 2), round(rnd.uniform(66.8, 99.9), 2)), (5, 2, 80, 13))[0]},
+            )
+            div_id += 1
+        battle_json[str(battle_id)] = {
+            "id": battle_id,
+            "start": now - rnd.randint(-10, 120) * 60,
+            "zone_id": rnd.randint(1, 12),
+            "region": {"name": f"Region {battle_id}"},
+            "inv": {"id": invader},
+            "def": {"id": defender},
+            "div": divisions,
+        }
+    return battle_json
+
+
+def synthetic_campaigns(battles: int, now: int = None, seed: int = 0) -> bytes:
+    """campaignsJson-like response body, battles padded with fields the bot doesn't use"""
+    rnd = random.Random(seed)
+    now = now or int(time.time())
+    battle_json = synthetic_battles(battles, now, seed)
+    for battle in battle_json.values():
+        battle.update(war_id=rnd.randint(1, 10 ** 6), war_type="direct", is_lib=False, is_dict=False, is_rw=False, type="tanks")
+        battle["region"].update(id=battle["id"], permalink=battle["region"]["name"].replace(" ", "-"))
+        for side in ("inv", "def"):
+            battle[side].update(
+                allies=rnd.sample(list(UTF_FLAG), 10), ally_list=[dict(id=c, environment_ok=True) for c in rnd.sample(list(UTF_FLAG), 10)], points=rnd.randint(0, 83)
+            )
+        for div in battle["div"].values():
+            div.update(division_end=False, co=dict(inv=[], def_=[]), stats=dict(inv=dict(damage=rnd.randint(0, 10 ** 9)), def_=dict(damage=rnd.randint(0, 10 ** 9))))
+            div["wall"].update(hit=rnd.randint(0, 10 ** 6))
+    return json.dumps(dict(battles=battle_json, countries={str(c): dict(id=c, name=f"Country {c}", allies=[]) for c in UTF_FLAG}, last_updated=now)).encode()
+
+
+def legacy_check_battles(battle_json: Dict[str, Dict[str, Any]], now: int) -> Generator[Tuple[str, int, DivisionData], None, None]:
+    """Reference implementation - builds DivisionData for every running division"""
+    for battle in sorted(battle_json.values(), key=itemgetter("start")):
+        if battle["start"] > now:
+            continue
+        region_name = battle["region"]["name"]
+        invader_flag = UTF_FLAG[battle["inv"]["id"]]
+        defender_flag = UTF_FLAG[battle["def"]["id"]]
+        for div in battle["div"].values():
+            if div["end"]:
+                continue
+            division = div["div"]
+            dom = div["wall"]["dom"]
+            epic = div["epic"]
+            division_meta_data = DivisionData(
+                region=region_name,
+                round_time=s_to_human(now - battle["start"]),
+                round_time_s=int(now - battle["start"]),
+                sides=[],
+                url=f"https://www.erepublik.com/en/military/battlefield/{battle['id']}",
+                zone_id=battle["zone_id"],
+                div_id=div["id"],
+                extra={},
+            )
+            if dom == 50:
+                division_meta_data.update(sides=[invader_flag, defender_flag])
+                yield "empty", division, division_meta_data
+                division_meta_data["sides"].clear()
+            if dom == 100:
+                division_meta_data.update(sides=[invader_flag if battle["def"]["id"] == div["wall"]["for"] else defender_flag])
+                yield "empty", division, division_meta_data
+                division_meta_data["sides"].clear()
+            if epic > 1:
+                division_meta_data.update(sides=[invader_flag, defender_flag])
+                division_meta_data["extra"].update(intensity_scale=div["intensity_scale"], epic_type=epic)
+                yield "epic", division, division_meta_data
+                division_meta_data["sides"].clear()
+                division_meta_data["extra"].clear()
+            if dom >= 66.8:
+                division_meta_data.update(sides=[invader_flag if battle["def"]["id"] == div["wall"]["for"] else defender_flag])
+                yield "steal", division, division_meta_data
+                division_meta_data["sides"].clear()
+
+
+def synthetic_messages(count: int, seed: int = 0) -> List[str]:
+    """RSS entry summaries built from SAMPLE_MESSAGES with random country names"""
+    rnd = random.Random(seed)
+    names = [country.name for country in COUNTRIES.values()]
+    messages = []
+    for n in range(count):
+        msg = SAMPLE_MESSAGES[n % len(SAMPLE_MESSAGES)]
+        for name in ("Latvia", "Russia", "Lithuania", "Estonia", "Poland"):
+            msg = msg.replace(name, rnd.choice(names))
+        messages.append(msg)
+    return messages
+
+
+def synthetic_feed(messages: List[str], newest: float = None, interval: int = 600) -> bytes:
+    """eRepublik shaped RSS feed with an item per message, newest first, published `interval` seconds apart"""
+    newest = time.time() if newest is None else newest
+    items = "".join(
+        f"<item><title>Military event</title><link>https://www.erepublik.com/en/main/news/military/all/Latvia/1</link>"
+        f"<description>{escape(msg)}</description><pubDate>{email.utils.formatdate(newest - n * interval)}</pubDate><guid>{n}</guid></item>\n"
+        for n, msg in enumerate(messages)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel><title>Military events</title>'
+        f"<link>https://www.erepublik.com/en/main/news/military/all/Latvia/1</link>\n{items}</channel></rss>"
+    ).encode()
+
+
+class Fixture:
+    """Payloads a benchmark runs against"""
+
+    def __init__(self, name: str, campaigns: bytes, messages: List[str]):
+        self.name = name
+        self.campaigns = campaigns
+        self.messages = messages
+        parsed = parse_campaigns(campaigns)
+        self.battle_json: Dict[str, Dict[str, Any]] = parsed["battles"]
+        self.now: int = parsed["last_updated"]
+
+    @classmethod
+    def synthetic(cls, name: str, battles: int, seed: int = 0) -> "Fixture":
+        return cls(name, synthetic_campaigns(battles, seed=seed), synthetic_messages(battles, seed))
+
+    @classmethod
+    def recorded(cls, path: str) -> "Fixture":
+        """Largest campaignsJson and every RSS entry summary from a `RECORD_DIR` archive"""
+        import feedparser
+
+        campaigns, messages = None, []
+        for entry in read_archive(path):
+            if entry.kind == "campaigns" and (campaigns is None or len(entry.body) > len(campaigns)):
+                campaigns = entry.body
+            elif entry.kind == "rss":
+                messages.extend(item["summary"] for item in feedparser.parse(entry.body).entries)
+        if campaigns is None:
+            raise ValueError(f"No campaignsJson recorded in {path}")
+        return cls("recorded", campaigns, messages or SAMPLE_MESSAGES)
+
+
+# Battle count of every synthetic fixture size
+SIZES = dict(small=50, medium=500, large=2000, huge=10000)
+
+
+def _best_ms(func: Callable[[], Any], repeat: int = 3) -> float:
+    """Best time of `repeat` runs in milliseconds, every run repeating func for at least 0.2s"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e3
+
+
+def bench_classifier(fixture: Fixture) -> Dict[str, float]:
+    classifier = EventClassifier(events)
+    messages = fixture.messages
+    return dict(
+        messages=len(messages),
+        linear_us_per_msg=_best_ms(lambda: [linear_classify(m) for m in messages]) / len(messages) * 1e3,
+        classifier_us_per_msg=_best_ms(lambda: [classifier.classify(m) for m in messages]) / len(messages) * 1e3,
+    )
+
+
+def bench_check_battles(fixture: Fixture) -> Dict[str, float]:
+    battle_json, now = fixture.battle_json, fixture.now
+    snapshot = ColumnarSnapshot(battle_json, now)
+    delta = set(random.Random(0).sample(snapshot.div_id.tolist(), len(snapshot) // 20))
+    return dict(
+        divisions=len(snapshot),
+        legacy_ms=_best_ms(lambda: list(legacy_check_battles(battle_json, now))),
+        columnar_ms=_best_ms(lambda: list(ColumnarSnapshot(battle_json, now).events())),
+        columnar_build_ms=_best_ms(lambda: ColumnarSnapshot(battle_json, now)),
+        columnar_delta_ms=_best_ms(lambda: list(snapshot.events(delta))),
+        columnar_masks_ms=_best_ms(lambda: snapshot.empty_tie_mask | snapshot.epic_mask | snapshot.steal_mask),
+    )
+
+
+def bench_parse_campaigns(fixture: Fixture) -> Dict[str, float]:
+    body = fixture.campaigns
+    results = dict(payload_kb=len(body) / 1024)
+    for name, parse in (("json_loads", json.loads), ("compact", parse_campaigns)):
+        results[f"{name}_ms"] = _best_ms(lambda: parse(body))
+        tracemalloc.start()
+        parsed = parse(body)
+        results[f"{name}_retained_kb"] = tracemalloc.get_traced_memory()[0] / 1024
+        results[f"{name}_peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+        del parsed
+    return results
+
+
+def bench_db(fixture: Fixture) -> Dict[str, float]:
+    """Notification channel/role lookups and epic bookkeeping with a channel per 10 battles"""
+    div_ids = ColumnarSnapshot(fixture.battle_json, fixture.now).div_id.tolist()
+    channels = max(10, len(fixture.battle_json) // 10)
+    database = DiscordDB(":memory:")
+    for channel_id in range(1, channels + 1):
+        for kind in ("epic", "empty"):
+            database.add_notification_channel(channel_id, channel_id, kind)
+            for division in (1, 2, 3, 4, 11):
+                if channel_id % 2:
+                    database.add_role_mapping_entry(kind, channel_id, division, channel_id * 100 + division)
+    database.add_epics(div_ids[::2])
+    lookups = [(channel_id, division) for channel_id in range(1, channels + 1) for division in (1, 2, 3, 4, 11)]
+
+    def role_lookups():
+        for channel_id, division in lookups:
+            database.get_role_id_for_channel_division(kind="epic", channel_id=channel_id, division=division)
+
+    start = time.perf_counter()
+    database.add_epics(div_id + 10 ** 9 for div_id in div_ids)
+    add_epics_ms = (time.perf_counter() - start) * 1e3
+    return dict(
+        channels=channels,
+        divisions=len(div_ids),
+        channel_ids_us=_best_ms(lambda: database.get_kind_notification_channel_ids("epic")) * 1e3,
+        role_lookup_us=_best_ms(role_lookups) / len(lookups) * 1e3,
+        unseen_epics_ms=_best_ms(lambda: database.get_unseen_epics(div_ids)),
+        add_epics_ms=add_epics_ms,
+    )
+
+
+def bench_rss(fixture: Fixture) -> Dict[str, float]:
+    """Find new entries in a 30 item feed, with one new entry and with every entry new"""
+    import feedparser
+
+    newest = time.time()
+    feed = synthetic_feed(fixture.messages[:30], newest)
+    watermark = newest - 1
+
+    def legacy():
+        return [entry for entry in reversed(feedparser.parse(feed).entries) if time.mktime(entry["published_parsed"]) > watermark]
+
+    return dict(
+        payload_kb=len(feed) / 1024,
+        feedparser_ms=_best_ms(legacy),
+        stream_one_new_ms=_best_ms(lambda: new_feed_entries(feed, watermark)),
+        stream_all_new_ms=_best_ms(lambda: new_feed_entries(feed, 0)),
+    )
+
+
+def bench_fan_out(fixture: Fixture) -> Dict[str, float]:
+    """Deliver an epic and an empty medal notification to a channel per 10 battles"""
+    channels = max(10, len(fixture.battle_json) // 10)
+    messages = [(channel_id, (f"<@&{channel_id}> epic battle detected!",), {}) for channel_id in range(channels) for _ in range(2)]
+
+    def fan_out(latency: float) -> float:
+        async def send(channel_id, *args, **kwargs):
+            await asyncio.sleep(latency)
+
+        async def run():
+            dispatcher = NotificationDispatcher(send)
+            start = time.perf_counter()
+            await dispatcher.fan_out(messages)
+            return (time.perf_counter() - start) * 1e3
+
+        return min(asyncio.run(run()) for _ in range(3))
+
+    return dict(messages=len(messages), overhead_ms=fan_out(0), simulated_10ms_send_ms=fan_out(0.01))
+
+
+BENCHMARKS: Dict[str, Callable[[Fixture], Dict[str, float]]] = dict(
+    classifier=bench_classifier,
+    check_battles=bench_check_battles,
+    parse_campaigns=bench_parse_campaigns,
+    db=bench_db,
+    rss=bench_rss,
+    fan_out=bench_fan_out,
+)
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+    """Timings (`*_ms`, `*_us*` metrics) that got slower than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, fixtures in results["results"].items():
+        for fixture, metrics in fixtures.items():
+            for metric, value in metrics.items():
+                if not (metric.endswith("_ms") or "_us" in metric):
+                    continue
+                previous = baseline.get("results", {}).get(name, {}).get(fixture, {}).get(metric)
+                if previous and value > previous * (1 + tolerance):
+                    regressions.append(f"{name}[{fixture}] {metric}: {previous:.3f} -> {value:.3f} (+{(value / previous - 1) * 100:.0f}%)")
+    return regressions
+
+
+def run(names: List[str], fixtures: List[Fixture]) -> Dict[str, Any]:
+    results = dict(
+        meta=dict(timestamp=int(time.time()), python=platform.python_version(), platform=platform.platform(), numpy=np.__version__),
+        results={},
+    )
+    for name in names:
+        for fixture in fixtures:
+            metrics = BENCHMARKS[name](fixture)
+            results["results"].setdefault(name, {})[fixture.name] = metrics
+            for metric, value in metrics.items():
+                print(f"{name:<16} {fixture.name:<10} {metric:<32} {value:12.3f}")
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot's hot paths")
+    parser.add_argument("benchmarks", nargs="*", help=f"Benchmarks to run from {', '.join(BENCHMARKS)}, default all")
+    parser.add_argument("--sizes", default="small,medium,large", help=f"Comma separated synthetic fixture sizes from {', '.join(SIZES)}")
+    parser.add_argument("--archive", help="Also run against the largest payloads of a RECORD_DIR archive")
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run, exits with 1 if anything got slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against --compare results")
+    args = parser.parse_args(args)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name!r}")
+
+    fixtures = [Fixture.synthetic(size, SIZES[size]) for size in args.sizes.split(",") if size]
+    if args.archive:
+        fixtures.append(Fixture.recorded(args.archive))
+    results = run(args.benchmarks or list(BENCHMARKS), fixtures)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
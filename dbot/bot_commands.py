@@ -1,44 +1,45 @@
+import datetime
 import sys
 
 from discord import Embed
 from discord.enums import ChannelType
 from discord.ext import commands
 
-from dbot.base import ADMIN_ID, DB, DIVISION_MAPPING, MESSAGES, NOTIFICATION_KINDS, logger
-from dbot.utils import check_battles, get_battle_page
+from dbot.base import ADMIN_ID, DB, DIVISION_MAPPING, LOOP_MONITOR, MESSAGES, NOTIFICATION_KINDS, logger
+from dbot.utils import get_empty_medal_index, timestamp
 
 __all__ = ["bot"]
 
 bot = commands.Bot(command_prefix="!")
 
 
-def _process_member(member):
-    if not DB.get_member(member.id):
-        DB.add_member(member.id, str(member))
+async def _process_member(member):
+    if not await DB.get_member(member.id):
+        await DB.add_member(member.id, str(member))
 
 
 async def control_register(ctx, *args):
     if " ".join(args) == "From AF With Love!":
-        DB.update_member(ctx.author.id, str(ctx.author), True)
+        await DB.update_member(ctx.author.id, str(ctx.author), True)
         return await ctx.send("✅ You have been registered and are allowed to issue commands privately! 🥳")
     return await ctx.send(MESSAGES["command_failed"])
 
 
 async def control_notify(ctx, kind):
     if kind == "epic":
-        if DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
+        if await DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
             return await ctx.send(MESSAGES["notifications_set"].format("epic battles"))
     elif kind == "events":
-        if DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
+        if await DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
             return await ctx.send(MESSAGES["notifications_set"].format("eLatvia's events"))
     elif kind == "empty":
-        if DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
+        if await DB.add_notification_channel(ctx.guild.id, ctx.channel.id, kind):
             return await ctx.send(MESSAGES["notifications_set"].format("empty medals"))
     return await ctx.send(MESSAGES["nothing_to_do"])
 
 
 async def control_unnotify(ctx, kind):
-    if DB.remove_kind_notification_channel(kind, ctx.channel.id):
+    if await DB.remove_kind_notification_channel(kind, ctx.channel.id):
         if kind == "epic":
             return await ctx.send(MESSAGES["notifications_unset"].format("epic battles"))
         if kind == "events":
@@ -53,19 +54,19 @@ async def control_mention_set(ctx, kind: str, division: str, role: str):
         if guild_role.mention == role:
             if not guild_role.mentionable:
                 return await ctx.send(f"❌ Unable to use {role=}, because this role is not globally mentionable!")
-            DB.add_role_mapping_entry(kind, ctx.channel.id, DIVISION_MAPPING[division], guild_role.id)
+            await DB.add_role_mapping_entry(kind, ctx.channel.id, DIVISION_MAPPING[division], guild_role.id)
             return await ctx.send(f"✅ Success! For {division} epics I will mention {guild_role.mention}")
     return await ctx.send(MESSAGES["command_failed"])
 
 
 async def control_mention_remove(ctx, kind: str, division: str):
-    if DB.remove_role_mapping(kind, ctx.channel.id, DIVISION_MAPPING[division]):
+    if await DB.remove_role_mapping(kind, ctx.channel.id, DIVISION_MAPPING[division]):
         return await ctx.send(f"✅ I won't mention here any role about {division} events!")
     return await ctx.send(MESSAGES["nothing_to_do"])
 
 
 async def control_order_set(ctx, battle_id, side):
-    if not DB.get_battle_order(battle_id):
+    if not await DB.get_battle_order(battle_id):
         side_id = None
         try:
             side_id = COUNTRIES[int(side)].id
@@ -74,21 +75,42 @@ async def control_order_set(ctx, battle_id, side):
                 side_id = [c for c in COUNTRIES.values() if side.lower() in repr(c).lower()][0].id
             except IndexError:
                 return await ctx.send(MESSAGES["command_failed"])
-        DB.set_battle_order(battle_id, side_id)
+        await DB.set_battle_order(battle_id, side_id)
         return await ctx.send(f"✅ Order has been set! {COUNTIRES[side_id].name} must win")
     return await ctx.send(MESSAGES["nothing_to_do"])
 
+
 async def control_order_unset(ctx, battle_id):
-    if DB.delete_battle_order(battle_id):
+    if await DB.delete_battle_order(battle_id):
         return await ctx.send(f"✅ Order has been unset!")
     return await ctx.send(MESSAGES["nothing_to_do"])
 
 
+async def control_loop(ctx, count: str = "3"):
+    try:
+        count = max(1, min(int(count), 10))
+    except ValueError:
+        return await ctx.send("❌ Number of stalls to show must be a number, eg. `!control loop 5`")
+    lag = LOOP_MONITOR.lag_stats()
+    description = (
+        f"Lag over last {lag['count']} heartbeats: p50 {lag['p50'] * 1000:.1f}ms, p95 {lag['p95'] * 1000:.1f}ms, max {lag['max'] * 1000:.1f}ms"
+        if lag["count"]
+        else "Monitor is not running"
+    )
+    embed = Embed(title="Event loop health", description=f"{description}\nStalls longer than {LOOP_MONITOR.threshold}s captured: {len(LOOP_MONITOR.stalls)}")
+    for stall in LOOP_MONITOR.recent_stalls(count):
+        started = datetime.datetime.fromtimestamp(stall.started_at).strftime("%F %T")
+        stack = "".join(stall.stack[-4:]).replace("`", "'")[-1000:]
+        embed.add_field(name=f"{started} blocked {stall.duration:.2f}s{'' if stall.finished else ' (still blocked)'}", value=f"```{stack or 'No stack'}```", inline=False)
+    return await ctx.send(embed=embed)
+
+
 async def control_order(ctx, action, *args):
     if action == "set":
         return await control_order_set(ctx, *args)
     return await ctx.send(MESSAGES["nothing_to_do"])
 
+
 @bot.event
 async def on_ready():
     logger.info("Bot loaded")
@@ -97,10 +119,13 @@ async def on_ready():
     logger.info("------")
 
 
+EMPTY_PAGE_SIZE = 10
+
+
 @bot.command()
-async def empty(ctx, division, minutes: int = 0):
-    _process_member(ctx.message.author)
-    if not (ctx.channel.id == 603527159109124096 or DB.get_member(ctx.message.author.id).get("pm_is_allowed")):
+async def empty(ctx, division, minutes: int = 0, page: int = 1):
+    await _process_member(ctx.message.author)
+    if not (ctx.channel.id == 603527159109124096 or (await DB.get_member(ctx.message.author.id)).get("pm_is_allowed")):
         return await ctx.send("Currently unavailable!")
     try:
         div = int(division)
@@ -114,15 +139,18 @@ async def empty(ctx, division, minutes: int = 0):
         title=f"Possibly empty {s_div} medals",
         description="'Empty' medals are being guessed based on the division wall. Expect false-positives!",
     )
-    for kind, div_div, data in check_battles(get_battle_page().get("battles")):
-        if kind == "empty" and div_div == div and data["round_time_s"] >= minutes * 60:
-            embed.add_field(
-                name=f"**Battle for {data['region']} {' '.join(data['sides'])}**",
-                value=f"[R{data['zone_id']} | Time {data['round_time']}]({data['url']})",
-            )
-            if len(embed.fields) >= 10:
-                return await ctx.send(embed=embed)
+    index, now = await get_empty_medal_index(), timestamp()
+    total = index.count(div, minutes * 60, now)
+    pages = (total + EMPTY_PAGE_SIZE - 1) // EMPTY_PAGE_SIZE
+    page = max(1, min(page, pages))
+    for data in index.query(div, minutes * 60, now, offset=(page - 1) * EMPTY_PAGE_SIZE, limit=EMPTY_PAGE_SIZE):
+        embed.add_field(
+            name=f"**Battle for {data['region']} {' '.join(data['sides'])}**",
+            value=f"[R{data['zone_id']} | Time {data['round_time']}]({data['url']})",
+        )
     if embed.fields:
+        if pages > 1:
+            embed.set_footer(text=f"Page {page}/{pages} ({total} medals), next page: !empty {division} {minutes} {page % pages + 1}")
         return await ctx.send(embed=embed)
     else:
         return await ctx.send(f"No empty {s_div} medals found")
@@ -131,14 +159,14 @@ async def empty(ctx, division, minutes: int = 0):
 @empty.error
 async def division_error(ctx, error):
     if isinstance(error, (commands.BadArgument, commands.MissingRequiredArgument)):
-        return await ctx.send("❌ Division is mandatory, eg, `!empty [1,2,3,4,11, d1,d2,d3,d4,air, D1,D2,D3,D4,Air] [1-120]`")
+        return await ctx.send("❌ Division is mandatory, eg, `!empty [1,2,3,4,11, d1,d2,d3,d4,air, D1,D2,D3,D4,Air] [1-120] [page]`")
     logger.exception(error, exc_info=error)
     await ctx.send("❌ Something went wrong! 😔")
 
 
 @bot.command()
 async def control(ctx: commands.Context, command: str, *args):
-    _process_member(ctx.message.author)
+    await _process_member(ctx.message.author)
     if command == "register":
         return await control_register(ctx, *args)
     if command in ["notify", "unnotify"]:
@@ -171,7 +199,7 @@ async def control(ctx: commands.Context, command: str, *args):
             if role:
                 role = role[0]
             kind = str(kind).lower()
-            if ctx.channel.id not in DB.get_kind_notification_channel_ids(kind):
+            if ctx.channel.id not in await DB.get_kind_notification_channel_ids(kind):
                 return await ctx.send(MESSAGES["only_registered_channels"])
             if kind not in ("epic", "empty"):
                 return await ctx.send(f"❌ {kind=} doesn't support division mentioning!")
@@ -192,6 +220,11 @@ async def control(ctx: commands.Context, command: str, *args):
             logger.warning(str(e), exc_info=e, stacklevel=3)
             return await ctx.send(MESSAGES["mention_help"].format(command=command))
 
+    if command == "loop":
+        if ctx.author.id != int(ADMIN_ID):
+            return await ctx.send(MESSAGES["not_bot_admin"])
+        return await control_loop(ctx, *args[:1])
+
     if command == "exit":
         if ctx.author.id == ADMIN_ID:
             await ctx.send(f"{ctx.author.mention} Bye!")
@@ -203,4 +236,3 @@ async def control(ctx: commands.Context, command: str, *args):
 async def control_error(ctx, error):
     logger.exception(error, exc_info=error)
     return await ctx.send(MESSAGES["command_failed"])
-
@@ -0,0 +1,76 @@
+import re
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+if TYPE_CHECKING:
+    from dbot.constants import EventKind
+
+__all__ = ["EventClassifier", "required_literal"]
+
+
+def required_literal(pattern: re.Pattern) -> str:
+    """Longest literal text that every match of the pattern must contain
+
+    Only literals on the top level of the pattern are considered, anything inside groups, branches or repeats might
+    not take part in a match. Returns empty string if pattern has no such literal.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return ""
+    chunks, chunk = [], []
+    for op, value in sre_parse.parse(pattern.pattern, pattern.flags):
+        if op is sre_parse.LITERAL:
+            chunk.append(chr(value))
+        else:
+            chunks.append("".join(chunk))
+            chunk = []
+    chunks.append("".join(chunk))
+    return max(chunks, key=len)
+
+
+class EventClassifier:
+    """Match a message against a list of EventKinds, returning the same kind a linear scan would.
+
+    Every kind's required literal is compiled into a single keyword scanner, so one pass over the message finds the
+    kinds that can possibly match and only those regexes are run (in their original order).
+    """
+
+    kinds: List["EventKind"]
+
+    def __init__(self, kinds: Iterable["EventKind"]):
+        self.kinds = list(kinds)
+        keywords: Dict[str, Set[int]] = {}
+        self._always: Set[int] = set()
+        for idx, kind in enumerate(self.kinds):
+            keyword = required_literal(kind.regex)
+            if keyword:
+                keywords.setdefault(keyword, set()).add(idx)
+            else:
+                self._always.add(idx)
+        # Regex alternation picks a single keyword per position, so a hit also implies every keyword contained in it
+        self._candidates: Dict[str, Set[int]] = {keyword: set().union(*(kinds for other, kinds in keywords.items() if other in keyword)) for keyword in keywords}
+        alternation = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+        self._scanner = re.compile(f"(?=({alternation}))") if keywords else None
+
+    def candidates(self, msg: str) -> List["EventKind"]:
+        """EventKinds which might match the message, in original order"""
+        indexes = set(self._always)
+        if self._scanner is not None:
+            for keyword in {m.group(1) for m in self._scanner.finditer(msg)}:
+                indexes.update(self._candidates[keyword])
+        return [self.kinds[idx] for idx in sorted(indexes)]
+
+    def classify(self, msg: str) -> Optional[Tuple["EventKind", Dict[str, Optional[str]]]]:
+        """Find the first EventKind matching the message
+
+        :param msg: str RSS entry summary
+        :return: matched EventKind and the match's groupdict or None if nothing matched
+        """
+        for kind in self.candidates(msg):
+            match = kind.regex.search(msg)
+            if match:
+                return kind, match.groupdict()
+        return None
@@ -1,18 +1,112 @@
+import json
 import logging
-from typing import Dict, List, Optional, Union
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Union
 
 from sqlite_utils import Database
-from sqlite_utils.db import NotFoundError
-
 
+from dbot.metrics import DB_QUERY_SECONDS, timed_methods
+
+# Prepared statements are cached per connection by their SQL text, every query below is a constant string
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every connection, journal mode only to database files
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    # WAL is still consistent after a crash with NORMAL, only the last commits may be lost on power failure
+    ("synchronous", "NORMAL"),
+    ("mmap_size", 64 * 1024 * 1024),
+    # Negative size is in KiB
+    ("cache_size", -8 * 1024),
+    ("temp_store", "MEMORY"),
+)
+
+Params = Union[Sequence[Any], Dict[str, Any]]
+
+
+def connect(db_name: str = "", **kwargs) -> sqlite3.Connection:
+    """Open a connection with a statement cache large enough for every DiscordDB query
+
+    :param db_name: str Database file, empty for an in-memory database
+    :param kwargs: Passed to `sqlite3.connect`
+    """
+    return sqlite3.connect(db_name or ":memory:", cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+
+
+def apply_pragmas(conn: sqlite3.Connection):
+    in_memory = conn.execute("PRAGMA database_list").fetchone()[2] == ""
+    for name, value in PRAGMAS:
+        if name == "journal_mode" and in_memory:
+            continue
+        conn.execute(f"PRAGMA {name} = {value}")
+
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return bool(conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone())
+
+
+def _migrate_initial_schema(conn: sqlite3.Connection):
+    conn.execute("CREATE TABLE IF NOT EXISTS member (id INTEGER PRIMARY KEY, name TEXT NOT NULL, pm_is_allowed INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS player (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS channel (id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, kind TEXT NOT NULL DEFAULT 'epic')")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_guild_id_channel_id_kind ON channel (guild_id, channel_id, kind)")
+    if _table_exists(conn, "notification_channel"):
+        conn.execute("INSERT OR IGNORE INTO channel (id, guild_id, channel_id, kind) SELECT id, guild_id, channel_id, kind FROM notification_channel")
+        conn.execute("DROP TABLE notification_channel")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS role_mapping (id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL REFERENCES channel(id), division INTEGER NOT NULL, role_id INTEGER NOT NULL)"
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_role_mapping_channel_id_division ON role_mapping (channel_id, division)")
+    conn.execute("CREATE TABLE IF NOT EXISTS rss_feed (id INTEGER PRIMARY KEY, timestamp FLOAT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS battleorder (id INTEGER PRIMARY KEY, battle_id INTEGER NOT NULL, side INTEGER NOT NULL DEFAULT 71)")
+
+    # Division table used to be recreated on every start and had no timestamps
+    if _table_exists(conn, "division") and "last_seen" not in [row[1] for row in conn.execute("PRAGMA table_info(division)")]:
+        conn.execute("DROP TABLE division")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS division (id INTEGER PRIMARY KEY, division_id INTEGER NOT NULL, epic INTEGER DEFAULT 0, empty INTEGER DEFAULT 0, "
+        "created_at INTEGER NOT NULL DEFAULT 0, last_seen INTEGER NOT NULL DEFAULT 0)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_division_division_id_epic_empty ON division (division_id, epic, empty)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_division_last_seen ON division (last_seen)")
+
+
+def _migrate_member_constraints(conn: sqlite3.Connection):
+    # Member tables created by old versions lack NOT NULL constraints and pm_is_allowed default
+    conn.execute("CREATE TABLE member_new (id INTEGER PRIMARY KEY, name TEXT NOT NULL, pm_is_allowed INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT INTO member_new (id, name, pm_is_allowed) SELECT id, COALESCE(name, ''), COALESCE(pm_is_allowed, 0) FROM member")
+    conn.execute("DROP TABLE member")
+    conn.execute("ALTER TABLE member_new RENAME TO member")
+
+
+# Schema version N is reached by applying the first N migrations
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_initial_schema,
+    _migrate_member_constraints,
+]
+
+
+# Notification lookups are served from memory, timing them would cost more than the lookup itself
+@timed_methods(DB_QUERY_SECONDS, exclude=("get_kind_notification_channel_ids", "get_role_id_for_channel_division"))
 class DiscordDB:
     _name: str
     _db: Database
+    _conn: sqlite3.Connection
+    # kind -> channel_id -> division -> role_id
+    _notification_cache: Dict[str, Dict[int, Dict[int, int]]]
 
-    def __init__(self, db_name: str = ""):
-        self._db = Database(db_name) if db_name else Database(memory=True)
+    def __init__(self, db_name: Union[str, sqlite3.Connection] = "", vacuum: bool = False):
+        """
+        :param db_name: Database file name or an open connection, empty for an in-memory database
+        :param vacuum: bool Rebuild database file after migrations
+        """
+        conn = db_name if isinstance(db_name, sqlite3.Connection) else connect(db_name)
+        apply_pragmas(conn)
+        self._db = Database(conn)
+        self._conn = conn
 
-        self.initialize()
+        self.initialize(vacuum)
 
         self.member = self._db.table("member")
         self.player = self._db.table("player")
@@ -22,47 +116,64 @@ class DiscordDB:
         self.role_mapping = self._db.table("role_mapping")
         self.battleorder = self._db.table("battleorder")
 
-    def initialize(self):
-        hard_tables = ["member", "player", "channel", "role_mapping"]
-        db_tables = self._db.table_names()
-        if "member" not in db_tables:
-            self._db.create_table("member", {"name": str, "pm_is_allowed": bool}, pk="id", not_null={"name", "pm_is_allowed"}, defaults={"pm_is_allowed": False})
-        else:
-            self._db.create_table("member_tmp", {"name": str, "pm_is_allowed": bool}, pk="id", not_null={"name", "pm_is_allowed"}, defaults={"pm_is_allowed": False})
-            for row in self._db.table("member").rows:
-                self._db["member_tmp"].insert(row)
-                logging.info(f"Moving row {row} to tmp member table")
-            self._db["member"].drop(True)
-            self._db.create_table("member", {"name": str, "pm_is_allowed": bool}, pk="id", not_null={"name", "pm_is_allowed"}, defaults={"pm_is_allowed": False})
-            for row in self._db.table("member_tmp").rows:
-                self._db["member"].insert(row)
-                logging.info(f"Moving row {row} from tmp member table")
-            self._db["member_tmp"].drop(True)
-
-        if "player" not in db_tables:
-            self._db.create_table("player", {"name": str}, pk="id", not_null={"name"})
-        if "notification_channel" in db_tables or "channel" not in db_tables:
+        self.defer_cache_refresh = False
+        self._cache_stale = False
+        self._load_notification_cache()
+
+    # Statement helpers, `sql` must be a constant so the prepared statement is reused
+
+    def _fetch_row(self, sql: str, params: Params = ()) -> Optional[Dict[str, Any]]:
+        cursor = self._conn.execute(sql, params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def _fetch_rows(self, sql: str, params: Params = ()) -> List[Dict[str, Any]]:
+        cursor = self._conn.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _fetch_value(self, sql: str, params: Params = (), default: Any = None) -> Any:
+        row = self._conn.execute(sql, params).fetchone()
+        return default if row is None else row[0]
+
+    def _write(self, sql: str, params: Params = ()) -> int:
+        """Execute a single statement in its own transaction
+
+        :return: int Number of changed rows
+        """
+        with self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    @property
+    def schema_version(self) -> int:
+        if not _table_exists(self._db.conn, "schema_version"):
+            return 0
+        return self._db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def initialize(self, vacuum: bool = False):
+        """Apply pending schema migrations in a single transaction
+
+        :param vacuum: bool Rebuild database file afterwards
+        """
+        version = self.schema_version
+        pending = MIGRATIONS[version:]
+        if pending:
+            conn = self._db.conn
+            conn.execute("BEGIN")
             try:
-                self._db.create_table("channel", {"guild_id": int, "channel_id": int, "kind": str}, pk="id", not_null={"guild_id", "channel_id", "kind"}, defaults={"kind": "epic"})
-                self._db["channel"].create_index(("guild_id", "channel_id", "kind"), unique=True)
-            except:
-                pass
-            for row in self._db.table("notification_channel").rows:
-                self._db["channel"].insert(row)
-        if "role_mapping" not in db_tables:
-            self._db.create_table("role_mapping", {"channel_id": int, "division": int, "role_id": int}, pk="id", not_null={"channel_id", "division", "role_id"})
-            self._db["role_mapping"].add_foreign_key("channel_id", "channel", "id")
-            self._db["role_mapping"].create_index(("channel_id", "division"), unique=True)
-
-        for table in self._db.table_names():
-            if table not in hard_tables:
-                self._db.table(table).drop(ignore=True)
-
-        self._db.create_table("division", {"division_id": int, "epic": bool, "empty": bool}, pk="id", defaults={"epic": False, "empty": False}, not_null={"division_id"})
-        self._db.create_table("rss_feed", {"timestamp": float}, pk="id", not_null={"timestamp"})
-        self._db.create_table("battleorder", {"battle_id": int, "side": int}, pk="id", not_null={"battle_id","side"}, defaults={"side":71})
-
-        self._db.vacuum()
+                conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)")
+                for version, migration in enumerate(pending, start=version + 1):
+                    logging.info(f"Migrating database to version {version} ({migration.__name__})")
+                    migration(conn)
+                    conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, int(time.time())))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        if vacuum:
+            self._db.vacuum()
 
     # Player methods
 
@@ -72,10 +183,7 @@ class DiscordDB:
         :param pid: int Player ID
         :return: player id, name if player exists
         """
-        try:
-            return self.player.get(pid)
-        except NotFoundError:
-            return None
+        return self._fetch_row("SELECT * FROM player WHERE id = ?", (pid,))
 
     def add_player(self, pid: int, name: str) -> bool:
         """Add player.
@@ -84,11 +192,7 @@ class DiscordDB:
         :param name: Player Name
         :return: bool Player added
         """
-        if not self.get_player(pid):
-            self.player.insert({"id": pid, "name": name})
-            return True
-        else:
-            return False
+        return bool(self._write("INSERT INTO player (id, name) VALUES (?, ?) ON CONFLICT (id) DO NOTHING", (pid, name)))
 
     def update_player(self, pid: int, name: str) -> bool:
         """Update player"s record
@@ -97,11 +201,7 @@ class DiscordDB:
         :param name: Player Name
         :return: bool
         """
-        if self.get_player(pid):
-            self.player.update(pid, {"name": name})
-            return True
-        else:
-            return False
+        return bool(self._write("UPDATE player SET name = ? WHERE id = ?", (name, pid)))
 
     # Member methods
 
@@ -113,10 +213,7 @@ class DiscordDB:
         :return: local id, name, mention number if discord member exists else None
         :rtype: Union[Dict[str, Union[int, str]], None]
         """
-        try:
-            return self.member.get(member_id)
-        except NotFoundError:
-            return {}
+        return self._fetch_row("SELECT * FROM member WHERE id = ?", (member_id,)) or {}
 
     def add_member(self, id: int, name: str, pm_is_allowed: bool = False) -> Dict[str, Union[int, str]]:
         """Add discord member.
@@ -126,9 +223,9 @@ class DiscordDB:
         :param pm_is_allowed: Allow discord member to contact bot through PMs
         """
         try:
-            self.member.insert({"id": id, "name": name, "pm_is_allowed": pm_is_allowed})
+            self._write("INSERT INTO member (id, name, pm_is_allowed) VALUES (?, ?, ?) ON CONFLICT (id) DO NOTHING", (id, name, pm_is_allowed))
         finally:
-            return self.member.get(id)
+            return self.get_member(id)
 
     def update_member(self, member_id: int, name: str, pm_is_allowed: bool = None) -> bool:
         """Update discord member"s record
@@ -141,13 +238,12 @@ class DiscordDB:
         :type pm_is_allowed: Optional[bool]
         :return: bool
         """
-        member = self.get_member(member_id)
-        if member:
-            if pm_is_allowed is None:
-                pm_is_allowed = self.member.get(member_id).get("pm_is_allowed")
-            self.member.update(member["id"], {"name": name, "pm_is_allowed": pm_is_allowed})
-            return True
-        self.add_member(member_id, name)
+        # New members are never allowed PMs, existing ones keep their setting unless it's given
+        self._write(
+            "INSERT INTO member (id, name, pm_is_allowed) VALUES (:id, :name, 0) "
+            "ON CONFLICT (id) DO UPDATE SET name = excluded.name, pm_is_allowed = COALESCE(:pm_is_allowed, pm_is_allowed)",
+            dict(id=member_id, name=name, pm_is_allowed=pm_is_allowed),
+        )
         return True
 
     # Epic Methods
@@ -158,10 +254,7 @@ class DiscordDB:
         :param division_id: int Division ID
         :return: bool
         """
-        try:
-            return bool(next(self.division.rows_where("division_id = ? and epic = ?", (division_id, True))))
-        except StopIteration:
-            return False
+        return bool(self._fetch_value("SELECT 1 FROM division WHERE division_id = ? AND epic = 1 LIMIT 1", (division_id,)))
 
     def add_epic(self, division_id: int) -> bool:
         """Register epic in division.
@@ -169,10 +262,7 @@ class DiscordDB:
         :param division_id: int Epic division ID
         :return: bool Epic division added
         """
-        if not self.check_epic(division_id):
-            self.division.insert({"division_id": division_id, "epic": True})
-            return True
-        return False
+        return bool(self._add_divisions("epic", (division_id,)))
 
     # Epic Methods
 
@@ -182,10 +272,7 @@ class DiscordDB:
         :param division_id: int Division ID
         :return: division id
         """
-        try:
-            return bool(next(self.division.rows_where("division_id = ? and empty = ?", (division_id, True))))
-        except StopIteration:
-            return False
+        return bool(self._fetch_value("SELECT 1 FROM division WHERE division_id = ? AND empty = 1 LIMIT 1", (division_id,)))
 
     def add_empty_medal(self, division_id: int) -> bool:
         """Add Epic division.
@@ -193,10 +280,72 @@ class DiscordDB:
         :param division_id: int Epic division ID
         :return: bool Epic division added
         """
-        if not self.check_empty_medal(division_id):
-            self.division.insert({"division_id": division_id, "empty": True})
-            return True
-        return False
+        return bool(self._add_divisions("empty", (division_id,)))
+
+    # Bulk Epic/Empty medal methods
+
+    def _get_unseen_divisions(self, flag: str, division_ids: Iterable[int]) -> Set[int]:
+        sql = f"SELECT ids.value FROM json_each(?) AS ids WHERE NOT EXISTS (SELECT 1 FROM division WHERE division_id = ids.value AND {flag} = 1)"
+        return {row[0] for row in self._conn.execute(sql, [json.dumps(list(set(division_ids)))]).fetchall()}
+
+    def _add_divisions(self, flag: str, division_ids: Iterable[int]) -> Set[int]:
+        now = int(time.time())
+        with self._conn:
+            unseen = self._get_unseen_divisions(flag, division_ids)
+            self._conn.executemany(f"INSERT INTO division (division_id, {flag}, created_at, last_seen) VALUES (?, 1, ?, ?)", [(division_id, now, now) for division_id in unseen])
+        return unseen
+
+    def get_unseen_epics(self, division_ids: Iterable[int]) -> Set[int]:
+        """Filter out divisions which already have an epic registered
+
+        :param division_ids: Division IDs from one campaigns snapshot
+        :return: Set of division IDs without registered epic
+        """
+        return self._get_unseen_divisions("epic", division_ids)
+
+    def add_epics(self, division_ids: Iterable[int]) -> Set[int]:
+        """Register epics in all divisions in a single transaction
+
+        :param division_ids: Epic division IDs
+        :return: Set of division IDs which were added
+        """
+        return self._add_divisions("epic", division_ids)
+
+    def get_unseen_empty_medals(self, division_ids: Iterable[int]) -> Set[int]:
+        """Filter out divisions which already have an empty medal registered
+
+        :param division_ids: Division IDs from one campaigns snapshot
+        :return: Set of division IDs without registered empty medal
+        """
+        return self._get_unseen_divisions("empty", division_ids)
+
+    def add_empty_medals(self, division_ids: Iterable[int]) -> Set[int]:
+        """Register empty medals in all divisions in a single transaction
+
+        :param division_ids: Empty medal division IDs
+        :return: Set of division IDs which were added
+        """
+        return self._add_divisions("empty", division_ids)
+
+    def touch_divisions(self, division_ids: Iterable[int], timestamp: int = None) -> None:
+        """Mark registered divisions as still running
+
+        :param division_ids: IDs of all running divisions from one campaigns snapshot
+        :param timestamp: int UNIX timestamp of the snapshot
+        """
+        sql = "UPDATE division SET last_seen = ? WHERE division_id IN (SELECT value FROM json_each(?))"
+        self._write(sql, (timestamp or int(time.time()), json.dumps(list(set(division_ids)))))
+
+    def prune_divisions(self, ended_after: int = 15 * 60, ttl: int = 6 * 60 * 60, timestamp: int = None) -> int:
+        """Forget registered epics and empty medals of finished divisions
+
+        :param ended_after: int Seconds since division was last seen running after which it's considered finished
+        :param ttl: int Seconds after which division is forgotten even if still running
+        :param timestamp: int UNIX timestamp to count from
+        :return: int Number of removed rows
+        """
+        now = timestamp or int(time.time())
+        return self._write("DELETE FROM division WHERE last_seen < ? OR created_at < ?", (now - ended_after, now - ttl))
 
     # RSS Event Methods
 
@@ -206,10 +355,7 @@ class DiscordDB:
         :param country_id: int Country ID
         :return: timestamp
         """
-        try:
-            return self.rss_feed.get(country_id)["timestamp"]
-        except NotFoundError:
-            return 0
+        return self._fetch_value("SELECT timestamp FROM rss_feed WHERE id = ?", (country_id,), 0)
 
     def set_rss_feed_timestamp(self, country_id: int, timestamp: float) -> None:
         """Set latest processed RSS Feed event's timestamp for country
@@ -217,33 +363,60 @@ class DiscordDB:
         :param country_id: int Country ID
         :param timestamp: float UNIX timestamp
         """
-        if self.get_rss_feed_timestamp(country_id):
-            self.rss_feed.update(country_id, {"timestamp": timestamp})
-        else:
-            self.rss_feed.insert({"id": country_id, "timestamp": timestamp})
+        self._write("INSERT INTO rss_feed (id, timestamp) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET timestamp = excluded.timestamp", (country_id, timestamp))
 
     # Notification methods
 
+    def _refresh_notification_cache(self):
+        """Reload notification channels and their role mappings into memory.
+
+        Must be called after every change to `channel` or `role_mapping` tables. While `defer_cache_refresh` is set the
+        change may still be rolled back, so the cache is only marked stale until `sync_notification_cache()` is called.
+        """
+        if self.defer_cache_refresh:
+            self._cache_stale = True
+        else:
+            self._load_notification_cache()
+
+    def sync_notification_cache(self):
+        """Reload the notification cache if a deferred change left it stale, call after the transaction ends"""
+        if self._cache_stale:
+            self._load_notification_cache()
+            self._cache_stale = False
+
+    def _load_notification_cache(self):
+        """Build a new notification mapping from committed tables and swap it in, so readers never see a half built cache"""
+        cache: Dict[str, Dict[int, Dict[int, int]]] = {}
+        for kind, channel_id in self._conn.execute("SELECT kind, channel_id FROM channel ORDER BY id").fetchall():
+            cache.setdefault(kind, {})[channel_id] = {}
+        for kind, channel_id, division, role_id in self._conn.execute(
+            "SELECT channel.kind, channel.channel_id, role_mapping.division, role_mapping.role_id FROM role_mapping JOIN channel ON channel.id = role_mapping.channel_id"
+        ).fetchall():
+            cache.setdefault(kind, {}).setdefault(channel_id, {})[division] = role_id
+        self._notification_cache = cache
+
     def add_notification_channel(self, guild_id: int, channel_id: int, kind: str) -> bool:
         if channel_id in self.get_kind_notification_channel_ids(kind):
             return False
-        self.channel.insert({"guild_id": guild_id, "channel_id": channel_id, "kind": kind})
+        self._write("INSERT INTO channel (guild_id, channel_id, kind) VALUES (?, ?, ?)", (guild_id, channel_id, kind))
+        self._refresh_notification_cache()
         return True
 
     def get_kind_notification_channel_ids(self, kind: str) -> List[int]:
-        channels = [row["channel_id"] for row in self.channel.rows_where("kind = ?", [kind])]
-        return channels
+        return list(self._notification_cache.get(kind, {}))
 
     def get_notification_channel_id(self, kind: str, *, guild_id: int = None, channel_id: int = None) -> Optional[int]:
         if guild_id is None and channel_id is None:
             raise RuntimeError("Must provide either guild_id or channel_id!")
-        for row in self.channel.rows_where(f"kind = ? and {'guild_id' if guild_id is not None else 'channel_id'} = ?", [kind, guild_id or channel_id]):
-            return row["id"]
+        if guild_id is not None:
+            return self._fetch_value("SELECT id FROM channel WHERE kind = ? AND guild_id = ? ORDER BY id LIMIT 1", (kind, guild_id))
+        return self._fetch_value("SELECT id FROM channel WHERE kind = ? AND channel_id = ? ORDER BY id LIMIT 1", (kind, channel_id))
 
     def remove_kind_notification_channel(self, kind, channel_id) -> bool:
         if channel_id in self.get_kind_notification_channel_ids(kind):
             self.remove_all_channel_role_mappings(channel_id, kind)
-            self.channel.delete_where("kind = ? and channel_id = ?", (kind, channel_id))
+            self._write("DELETE FROM channel WHERE kind = ? AND channel_id = ?", (kind, channel_id))
+            self._refresh_notification_cache()
             return True
         return False
 
@@ -253,51 +426,38 @@ class DiscordDB:
         ch_id = self.get_notification_channel_id(kind, channel_id=channel_id)
         if division not in (1, 2, 3, 4, 11):
             return False
-        try:
-            row = next(self.role_mapping.rows_where("channel_id = ? and division = ?", [ch_id, division]))
-            self.role_mapping.update(row["id"], {"channel_id": ch_id, "division": division, "role_id": role_id})
-        except StopIteration:
-            self.role_mapping.insert({"channel_id": ch_id, "division": division, "role_id": role_id})
+        self._write(
+            "INSERT INTO role_mapping (channel_id, division, role_id) VALUES (?, ?, ?) ON CONFLICT (channel_id, division) DO UPDATE SET role_id = excluded.role_id",
+            (ch_id, division, role_id),
+        )
+        self._refresh_notification_cache()
         return True
 
     def remove_all_channel_role_mappings(self, channel_id: int, kind: str):
         ch_id = self.get_notification_channel_id(kind, channel_id=channel_id)
-        for d in (1, 2, 3, 4, 11):
-            self.remove_role_mapping(kind, ch_id, d)
+        self._write("DELETE FROM role_mapping WHERE channel_id = ?", (ch_id,))
+        self._refresh_notification_cache()
 
     def remove_role_mapping(self, kind: str, channel_id: int, division_id: int) -> bool:
-        try:
-            ch_id = self.get_notification_channel_id(kind, channel_id=channel_id)
-            row = next(self.role_mapping.rows_where("channel_id = ? and division = ? ", (ch_id, division_id)))
-            self.role_mapping.delete(row["id"])
+        ch_id = self.get_notification_channel_id(kind, channel_id=channel_id)
+        if self._write("DELETE FROM role_mapping WHERE channel_id = ? AND division = ?", (ch_id, division_id)):
+            self._refresh_notification_cache()
             return True
-        except StopIteration:
-            return False
+        return False
 
     def get_role_id_for_channel_division(self, *, kind: str, channel_id: int, division: int) -> Optional[int]:
-        ch_id = self.get_notification_channel_id(kind, channel_id=channel_id)
-        rows = self.role_mapping.rows_where("channel_id = ? and division = ?", (ch_id, division))
-        for row in rows:
-            return row["role_id"]
+        return self._notification_cache.get(kind, {}).get(channel_id, {}).get(division)
 
-    def set_battle_order(self, battle_id:int, side:int):
+    def set_battle_order(self, battle_id: int, side: int):
         if self.get_battle_order(battle_id):
             return False
-        self.battleorder.insert(dict(battle_id=battle_id, side=side))
+        self._write("INSERT INTO battleorder (battle_id, side) VALUES (?, ?)", (battle_id, side))
         return True
 
     def get_battle_order(self, battle_id: int = None):
         if battle_id is None:
-            return list(sef.battleorder.rows)
-        try:
-            row = next(self.battleorder.rows_where('battle_id = ?', (battle_id,)))
-            return row
-        except StopIterationError:
-            return
+            return self._fetch_rows("SELECT * FROM battleorder ORDER BY id")
+        return self._fetch_row("SELECT * FROM battleorder WHERE battle_id = ? ORDER BY id LIMIT 1", (battle_id,))
 
     def delete_battle_order(self, battle_id: int):
-        bo = self.get_battle_order(battle_id)
-        if bo:
-            DB.battleorder.delete(bo['id'])
-            return True
-        return False
+        return bool(self._write("DELETE FROM battleorder WHERE battle_id = ?", (battle_id,)))
@@ -0,0 +1,47 @@
+import heapq
+import math
+from typing import Iterable, List, Optional, Set
+
+__all__ = ["DeadlineQueue"]
+
+
+class DeadlineQueue:
+    """Upcoming wake-up times, coalesced into `resolution` second slots.
+
+    Deadlines are rounded up to the next slot boundary, so deadlines a few seconds apart share a single wake-up which
+    fires at most `resolution` seconds late, never early.
+    """
+
+    def __init__(self, resolution: float = 5):
+        """
+        :param resolution: float Slot length in seconds
+        """
+        self.resolution = resolution
+        self._heap: List[float] = []
+        self._slots: Set[float] = set()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def add(self, deadline: float):
+        slot = math.ceil(deadline / self.resolution) * self.resolution
+        if slot not in self._slots:
+            self._slots.add(slot)
+            heapq.heappush(self._heap, slot)
+
+    def add_many(self, deadlines: Iterable[float]):
+        for deadline in deadlines:
+            self.add(deadline)
+
+    def next_deadline(self) -> Optional[float]:
+        """Earliest pending wake-up time, None if there is none"""
+        return self._heap[0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[float]:
+        """Remove and return every wake-up time which has passed"""
+        due = []
+        while self._heap and self._heap[0] <= now:
+            slot = heapq.heappop(self._heap)
+            self._slots.discard(slot)
+            due.append(slot)
+        return due
@@ -2,165 +2,309 @@ import asyncio
 import datetime
 import logging
 import time
+from typing import Any, Callable, List, Optional
 
 import discord
-import feedparser
 import pytz
-import requests
 from constants import events
+from discord.ext import commands
 from erepublik.constants import COUNTRIES
 
-from dbot.base import ADMIN_ID, DB, DB_NAME, DEFAULT_CHANNEL_ID, DISCORD_TOKEN, PRODUCTION, logger
+from dbot import metrics
+from dbot.base import (
+    ADMIN_ID,
+    DB,
+    DB_NAME,
+    DEFAULT_CHANNEL_ID,
+    DIGEST_WINDOW,
+    DISCORD_TOKEN,
+    HTTP,
+    LOOP_MONITOR,
+    METRICS_HOST,
+    METRICS_PORT,
+    NOTIFICATION_MODE,
+    NOTIFICATION_WORKERS,
+    PRODUCTION,
+    RECORDER,
+    RSS_CONCURRENCY,
+    RSS_HOST_DELAY,
+    RSS_MAX_INTERVAL,
+    RSS_MIN_INTERVAL,
+    RSS_PER_HOST,
+    RSS_REQUESTS_PER_MINUTE,
+    logger,
+)
 from dbot.bot_commands import bot
-from dbot.utils import check_battles, get_battle_page, timestamp
+from dbot.classifier import EventClassifier
+from dbot.deadlines import DeadlineQueue
+from dbot.dispatch import DigestBuffer, NotificationDispatcher
+from dbot.metrics import CHECK_BATTLES_DIVISIONS, CHECK_BATTLES_SECONDS, EPIC_ALERT_LAG_SECONDS
+from dbot.provider import SnapshotUnavailable
+from dbot.rss import RssPoller, RssScheduler, new_feed_entries
+from dbot.snapshot import ColumnarSnapshot, SnapshotDiffer
+from dbot.utils import BATTLE_PAGE, get_battle_page, timestamp
 
 if PRODUCTION:
     logger.warning("Production mode enabled!")
     logger.setLevel(logging.INFO)
-    _ts = int(time.time())
-    for c_id in COUNTRIES.keys():
-        DB.set_rss_feed_timestamp(c_id, _ts)
-    del _ts
+
+EMPTY_MEDAL_ROUND_TIME = 85 * 60
+CLASSIFIER = EventClassifier(events)
+RSS = RssPoller(HTTP, concurrency=RSS_CONCURRENCY, per_host=RSS_PER_HOST, host_delay=RSS_HOST_DELAY)
 
 logger.debug(f"Active configs:\nDISCORD_TOKEN='{DISCORD_TOKEN}'\nDEFAULT_CHANNEL_ID='{DEFAULT_CHANNEL_ID}'\nADMIN_ID='{ADMIN_ID}'\nDB_NAME='{DB_NAME}'")
 
 
-class MyClient(discord.Client):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # create the background task and run it in the background
+class Watchers(commands.Cog):
+    """Battle and RSS watchers running as background tasks of the commands bot, so both share one gateway connection"""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.battle_task: Optional[asyncio.Task] = None
+        self.rss_task: Optional[asyncio.Task] = None
         self.last_event_timestamp = timestamp()
+        self.next_division_prune = 0
+        self.battle_differ = SnapshotDiffer(EMPTY_MEDAL_ROUND_TIME)
+        # Times when running rounds reach EMPTY_MEDAL_ROUND_TIME
+        self.empty_medal_deadlines = DeadlineQueue()
+        self.dispatcher = NotificationDispatcher(self.deliver, workers=NOTIFICATION_WORKERS)
+        self.digest = DigestBuffer(self.dispatcher, window=DIGEST_WINDOW) if NOTIFICATION_MODE == "digest" else None
+        # Only events involving Latvia are announced, so Latvia's feed weighs more in the budget split
+        self.rss_schedule = RssScheduler(COUNTRIES, budget=RSS_REQUESTS_PER_MINUTE / 60, min_interval=RSS_MIN_INTERVAL, max_interval=RSS_MAX_INTERVAL, weights={71: 4})
 
+    @commands.Cog.listener()
     async def on_ready(self):
-        logger.info("Client running")
-        logger.info("------")
-        self.bg_task = self.loop.create_task(self.report_battle_events())
-        # self.bg_rss_task = self.loop.create_task(self.report_rss_events())
+        # on_ready is dispatched again after every reconnect, watchers must only be started once
+        if self.battle_task is None or self.battle_task.done():
+            self.battle_task = asyncio.ensure_future(self.report_battle_events())
+        if self.rss_task is None or self.rss_task.done():
+            self.rss_task = asyncio.ensure_future(self.report_rss_events())
+        logger.info("Watchers running")
 
-    async def on_error(self, event_method, *args, **kwargs):
-        logger.warning(f"Ignoring exception in {event_method}")
+    def cog_unload(self):
+        for task in (self.battle_task, self.rss_task):
+            if task is not None:
+                task.cancel()
 
     async def send_msg(self, channel_id, *args, **kwargs):
         if PRODUCTION:
-            return self.get_channel(channel_id).send(*args, **kwargs)
+            return self.bot.get_channel(channel_id).send(*args, **kwargs)
         else:
             return logger.debug(f"Sending message to: {channel_id}\nArgs: {args}\nKwargs{kwargs}")
 
+    async def deliver(self, channel_id, *args, **kwargs):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            raise LookupError(f"Channel {channel_id} is not available")
+        return await channel.send(*args, **kwargs)
+
+    async def notify(self, messages, sent: Optional[Callable[[], Any]] = None):
+        """Send messages right away or add them to the digest, depending on NOTIFICATION_MODE
+
+        :param sent: Called once every message was delivered (or failed), in digest mode only after the digest went out
+        """
+        if self.digest is not None:
+            waiters = self.digest.add(messages)
+            if sent is not None:
+                asyncio.gather(*waiters).add_done_callback(lambda _: sent())
+        else:
+            await self.dispatcher.fan_out(messages)
+            if sent is not None:
+                sent()
+
     async def report_rss_events(self):
-        await self.wait_until_ready()
-        feed_response = None
-        while not self.is_closed():
+        await self.bot.wait_until_ready()
+        if PRODUCTION:
+            # Don't announce events which happened before the start
+            now = int(time.time())
+            await asyncio.gather(*(DB.set_rss_feed_timestamp(c_id, now) for c_id in COUNTRIES.keys()))
+        while not self.bot.is_closed():
             try:
-                for country in COUNTRIES.values():
-                    latest_ts = DB.get_rss_feed_timestamp(country.id)
-                    rss_link = f"https://www.erepublik.com/en/main/news/military/all/{country.link}/1/rss"
-                    feed_response = requests.get(rss_link)
-                    feed_response.raise_for_status()
-                    for entry in reversed(feedparser.parse(feed_response.text).entries):
-                        entry_ts = time.mktime(entry["published_parsed"])
-                        entry_link = entry["link"]
-                        # Check if event timestamp is after latest processed event for country
-                        if entry_ts > latest_ts:
-                            DB.set_rss_feed_timestamp(country.id, entry_ts)
-                            title = text = ""
-                            msg = entry["summary"]
-                            dont_send = False
-                            for kind in events:
-                                match = kind.regex.search(msg)
-                                if match:
-                                    values = match.groupdict()
-                                    # Special case for Dictator/Liberation wars
-                                    if "invader" in values and not values["invader"]:
-                                        values["invader"] = values["defender"]
-
-                                    # Special case for resource concession
-                                    if "link" in values:
-                                        __link = values["link"]
-                                        entry_link = __link if __link.startswith("http") else f"https://www.erepublik.com{__link}"
-                                        logger.debug(kind.format.format(**dict(match.groupdict(), **{"current_country": country.name})))
-                                        logger.debug(entry_link)
-                                    is_latvia = country.id == 71
-                                    has_latvia = any("Latvia" in v for v in values.values())
-                                    if is_latvia or has_latvia:
-                                        text = kind.format.format(**dict(match.groupdict(), **{"current_country": country.name}))
-                                        title = kind.name
-                                    else:
-                                        dont_send = True
-                                    break
-                            else:
-                                logger.warning(f"Unable to parse: {str(entry)}")
-                                continue
-
-                            if dont_send:
-                                continue
-
-                            entry_datetime = datetime.datetime.fromtimestamp(entry_ts, pytz.timezone("US/Pacific"))
-                            embed = discord.Embed(title=title, url=entry_link, description=text)
-                            embed.set_author(name=country.name, icon_url=f"https://www.erepublik.com/images/flags/L/{country.link}.gif")
-                            embed.set_footer(text=f"{entry_datetime.strftime('%F %T')} (eRepublik time)")
-
-                            logger.debug(f"Message sent: {text}")
-                            for channel_id in DB.get_kind_notification_channel_ids("events"):
-                                await self.get_channel(channel_id).send(embed=embed)
+                await asyncio.sleep(max(self.rss_schedule.next_due() - time.time(), 0))
+                due = self.rss_schedule.due()
+                async for country, feed_response in RSS.poll(COUNTRIES[country_id] for country_id in due):
+                    if isinstance(feed_response, Exception):
+                        logger.warning(f"Unable to fetch {country.name} RSS feed: {feed_response!r}")
+                        continue
+                    if feed_response.not_modified:
+                        # Same feed as on the previous poll, nothing to parse
+                        continue
+                    if RECORDER is not None:
+                        RECORDER.record("rss", country.id, feed_response.body)
+                    try:
+                        self.rss_schedule.record(country.id, await self.process_rss_feed(country, feed_response.body))
+                        RSS.processed(country)
+                    except Exception as e:
+                        RSS.failed(country)
+                        logger.error("eRepublik event reader ran into a problem!", exc_info=e)
+                        with open(f"debug/{timestamp()}_{country.id}.rss", "wb") as f:
+                            f.write(feed_response.body)
             except Exception as e:
                 logger.error("eRepublik event reader ran into a problem!", exc_info=e)
-                try:
-                    with open(f"debug/{timestamp()}.rss", "w") as f:
-                        f.write(feed_response.text)
-                except (NameError, AttributeError):
-                    logger.error("There was no Response object!", exc_info=e)
-            finally:
-                await asyncio.sleep((timestamp() // 300 + 1) * 300 - timestamp())
+                await asyncio.sleep(60)
+
+    async def process_rss_feed(self, country, feed: bytes) -> List[float]:
+        """Announce new events from a country's RSS feed
+
+        :return: UNIX timestamps of the new events
+        """
+        latest_ts = await DB.get_rss_feed_timestamp(country.id)
+        entries = new_feed_entries(feed, latest_ts)
+        for entry in entries:
+            entry_ts = entry.timestamp
+            entry_link = entry.link
+            await DB.set_rss_feed_timestamp(country.id, entry_ts)
+            title = text = ""
+            msg = entry.summary
+            dont_send = False
+            classified = CLASSIFIER.classify(msg)
+            if classified is None:
+                logger.warning(f"Unable to parse: {str(entry)}")
+                continue
+            kind, groups = classified
+            values = dict(groups)
+            # Special case for Dictator/Liberation wars
+            if "invader" in values and not values["invader"]:
+                values["invader"] = values["defender"]
+
+            # Special case for resource concession
+            if "link" in values:
+                __link = values["link"]
+                entry_link = __link if __link.startswith("http") else f"https://www.erepublik.com{__link}"
+                logger.debug(kind.format.format(**dict(groups, **{"current_country": country.name})))
+                logger.debug(entry_link)
+            is_latvia = country.id == 71
+            has_latvia = any("Latvia" in v for v in values.values())
+            if is_latvia or has_latvia:
+                text = kind.format.format(**dict(groups, **{"current_country": country.name}))
+                title = kind.name
+            else:
+                dont_send = True
+
+            if dont_send:
+                continue
+
+            entry_datetime = datetime.datetime.fromtimestamp(entry_ts, pytz.timezone("US/Pacific"))
+            embed = discord.Embed(title=title, url=entry_link, description=text)
+            embed.set_author(name=country.name, icon_url=f"https://www.erepublik.com/images/flags/L/{country.link}.gif")
+            embed.set_footer(text=f"{entry_datetime.strftime('%F %T')} (eRepublik time)")
+
+            logger.debug(f"Message sent: {text}")
+            await self.notify((channel_id, (), dict(embed=embed)) for channel_id in await DB.get_kind_notification_channel_ids("events"))
+        return [entry.unix_timestamp for entry in entries]
+
+    async def check_battle_page(self, r, now: int):
+        """Notify about new epic battles and empty medals in a campaignsJson snapshot
+
+        :param r: parsed campaignsJson
+        :param now: int Timestamp to calculate round times against
+        """
+        desc = "'Empty' medals are being guessed based on the division wall. Expect false-positives!"
+        empty_divisions = {
+            1: discord.Embed(title="Possibly empty **__last-minute__ D1** medals", description=desc),
+            2: discord.Embed(title="Possibly empty **__last-minute__ D2** medals", description=desc),
+            3: discord.Embed(title="Possibly empty **__last-minute__ D3** medals", description=desc),
+            4: discord.Embed(title="Possibly empty **__last-minute__ D4** medals", description=desc),
+            11: discord.Embed(title="Possibly empty **__last-minute__ Air** medals", description=desc),
+        }
+        epics, empty_medals = [], []
+        started = time.perf_counter()
+        snapshot = ColumnarSnapshot(r["battles"], now)
+        delta = self.battle_differ.diff_snapshot(snapshot)
+        CHECK_BATTLES_DIVISIONS.set(len(snapshot), scope="running")
+        CHECK_BATTLES_DIVISIONS.set(len(delta.active), scope="scanned")
+        logger.debug(f"Battle snapshot: {len(delta.added)} added, {len(delta.ended)} ended, {len(delta.changed)} changed, {len(delta.crossed)} crossed")
+        for kind, div, data in snapshot.events(delta.active):
+            if kind == "epic":
+                embed_data = dict(
+                    title=" ".join(data["extra"]["intensity_scale"].split("_")).title(),
+                    url=data["url"],
+                    description=f"Epic battle {' vs '.join(data['sides'])}!\nBattle for {data['region']}, Round {data['zone_id']}",
+                    footer=dict(text=f"Round time {data['round_time']}"),
+                )
+                epics.append((div, data["div_id"], embed_data))
+
+            if kind == "empty" and data["round_time_s"] >= EMPTY_MEDAL_ROUND_TIME:
+                field = dict(name=f"**Battle for {data['region']} {' '.join(data['sides'])}**", value=f"[R{data['zone_id']} | Time {data['round_time']}]({data['url']})")
+                empty_medals.append((div, data["div_id"], field))
+
+        epic_alerts, messages = [], []
+        new_epics, new_empty_medals = await asyncio.gather(
+            DB.get_unseen_epics([div_id for _, div_id, _ in epics]), DB.get_unseen_empty_medals([div_id for _, div_id, _ in empty_medals])
+        )
+        for div, div_id, embed_data in epics:
+            if div_id not in new_epics:
+                continue
+            embed = discord.Embed.from_dict(embed_data)
+            logger.debug(f"{embed_data=}")
+            alerts = []
+            for channel_id in await DB.get_kind_notification_channel_ids("epic"):
+                if role_id := await DB.get_role_id_for_channel_division(kind="epic", channel_id=channel_id, division=div):
+                    alerts.append((channel_id, (f"<@&{role_id}> epic battle detected!",), dict(embed=embed)))
+                else:
+                    alerts.append((channel_id, (), dict(embed=embed)))
+            epic_alerts.append(alerts)
+
+        for div, div_id, field in empty_medals:
+            if div_id in new_empty_medals:
+                empty_divisions[div].add_field(**field)
+
+        # Queued together, so the writer thread commits them in a single transaction
+        writes = [DB.add_epics(new_epics), DB.add_empty_medals(new_empty_medals), DB.touch_divisions(snapshot.div_id.tolist())]
+        if timestamp() >= self.next_division_prune:
+            writes.append(DB.prune_divisions())
+            self.next_division_prune = timestamp() + 10 * 60
+        _, _, _, *pruned = await asyncio.gather(*writes)
+        if pruned:
+            logger.debug(f"Pruned {pruned[0]} finished divisions")
+        for d, e in empty_divisions.items():
+            if e.fields:
+                for channel_id in await DB.get_kind_notification_channel_ids("empty"):
+                    if role_id := await DB.get_role_id_for_channel_division(kind="empty", channel_id=channel_id, division=d):
+                        messages.append((channel_id, (f"<@&{role_id}> empty medals in late rounds!",), dict(embed=e)))
+                    else:
+                        messages.append((channel_id, (), dict(embed=e)))
+        CHECK_BATTLES_SECONDS.observe(time.perf_counter() - started)
+        updated = r.get("last_updated", now)
+
+        def epic_sent():
+            EPIC_ALERT_LAG_SECONDS.observe(time.time() - updated)
+
+        # Epic alerts are submitted first, so they stay ahead of empty medals in every channel's queue. Epics nobody is
+        # subscribed to aren't sent, so they have no lag to observe
+        await asyncio.gather(*(self.notify(alerts, sent=epic_sent) for alerts in epic_alerts if alerts), self.notify(messages))
+        logger.debug(f"Send latency: {self.dispatcher.latency_stats()}")
+        self.battle_differ.commit()
+        self.empty_medal_deadlines.add_many(start + EMPTY_MEDAL_ROUND_TIME for start in set(snapshot.start.tolist()) if start + EMPTY_MEDAL_ROUND_TIME > now)
+
+    async def recheck_until(self, r, until: float):
+        """Re-check the last snapshot whenever a round reaches the empty medal threshold before the next poll
+
+        Only the divisions crossing the threshold are scanned, the differ sees nothing else changed since the last check.
+
+        :param r: parsed campaignsJson the last check ran on
+        :param until: float Timestamp of the next poll
+        """
+        while (deadline := self.empty_medal_deadlines.next_deadline()) is not None and deadline < until:
+            await asyncio.sleep(max(deadline - time.time(), 0))
+            if self.empty_medal_deadlines.pop_due(time.time()) and isinstance(r.get("battles"), dict):
+                await self.check_battle_page(r, timestamp())
+        await asyncio.sleep(max(until - timestamp(), 0))
 
     async def report_battle_events(self):
-        await self.wait_until_ready()
-        while not self.is_closed():
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
             try:
-                r = get_battle_page()
+                r = await get_battle_page(allow_stale=False)
                 if not isinstance(r.get("battles"), dict):
-                    sleep_seconds = r.get("last_updated") + 60 - timestamp()
-                    await asyncio.sleep(sleep_seconds if sleep_seconds > 0 else 0)
+                    await asyncio.sleep(max(BATTLE_PAGE.expires_at - timestamp(), 0))
                     continue
 
-                desc = "'Empty' medals are being guessed based on the division wall. Expect false-positives!"
-                empty_divisions = {
-                    1: discord.Embed(title="Possibly empty **__last-minute__ D1** medals", description=desc),
-                    2: discord.Embed(title="Possibly empty **__last-minute__ D2** medals", description=desc),
-                    3: discord.Embed(title="Possibly empty **__last-minute__ D3** medals", description=desc),
-                    4: discord.Embed(title="Possibly empty **__last-minute__ D4** medals", description=desc),
-                    11: discord.Embed(title="Possibly empty **__last-minute__ Air** medals", description=desc),
-                }
-                for kind, div, data in check_battles(r.get("battles")):
-                    if kind == "epic" and not DB.check_epic(data["div_id"]):
-                        embed_data = dict(
-                            title=" ".join(data["extra"]["intensity_scale"].split("_")).title(),
-                            url=data["url"],
-                            description=f"Epic battle {' vs '.join(data['sides'])}!\nBattle for {data['region']}, Round {data['zone_id']}",
-                            footer=f"Round time {data['round_time']}",
-                        )
-                        embed = discord.Embed.from_dict(embed_data)
-                        logger.debug(f"{embed_data=}")
-                        for channel_id in DB.get_kind_notification_channel_ids("epic"):
-                            if role_id := DB.get_role_id_for_channel_division(kind="epic", channel_id=channel_id, division=div):
-                                await self.get_channel(channel_id).send(f"<@&{role_id}> epic battle detected!", embed=embed)
-                            else:
-                                await self.get_channel(channel_id).send(embed=embed)
-                        DB.add_epic(data["div_id"])
-
-                    if kind == "empty" and data["round_time_s"] >= 85 * 60 and not DB.check_empty_medal(data["div_id"]):
-                        empty_divisions[div].add_field(
-                            name=f"**Battle for {data['region']} {' '.join(data['sides'])}**", value=f"[R{data['zone_id']} | Time {data['round_time']}]({data['url']})"
-                        )
-                        DB.add_empty_medal(data["div_id"])
-                for d, e in empty_divisions.items():
-                    if e.fields:
-                        for channel_id in DB.get_kind_notification_channel_ids("empty"):
-                            if role_id := DB.get_role_id_for_channel_division(kind="empty", channel_id=channel_id, division=d):
-                                await self.get_channel(channel_id).send(f"<@&{role_id}> empty medals in late rounds!", embed=e)
-                            else:
-                                await self.get_channel(channel_id).send(embed=e)
-                sleep_seconds = r.get("last_updated") + 60 - timestamp()
-                await asyncio.sleep(sleep_seconds if sleep_seconds > 0 else 0)
+                await self.check_battle_page(r, timestamp())
+                await self.recheck_until(r, BATTLE_PAGE.expires_at)
+            except SnapshotUnavailable as e:
+                logger.warning(f"Skipping battle check: {e}")
+                await asyncio.sleep(max(e.retry_at - timestamp(), 1))
             except Exception as e:
                 logger.error("Discord bot's eRepublik epic watcher died!", exc_info=e)
                 try:
@@ -169,19 +313,21 @@ class MyClient(discord.Client):
                 except NameError:
                     logger.error("There was no Response object!", exc_info=e)
                 await asyncio.sleep(10)
-        await self.get_channel(DEFAULT_CHANNEL_ID).send(f"<@{ADMIN_ID}> I've stopped, please restart")
+        await self.bot.get_channel(DEFAULT_CHANNEL_ID).send(f"<@{ADMIN_ID}> I've stopped, please restart")
 
 
 loop = asyncio.get_event_loop()
-client = MyClient()
 
 
 def main():
     global loop
+    LOOP_MONITOR.start(loop)
+    bot.add_cog(Watchers(bot))
     logger.info("Starting Bot loop")
     loop.create_task(bot.start(DISCORD_TOKEN))
-    logger.info("Starting Client loop")
-    loop.create_task(client.start(DISCORD_TOKEN))
+    if METRICS_PORT:
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        loop.create_task(metrics.serve(METRICS_HOST, METRICS_PORT))
     loop.run_forever()
 
 
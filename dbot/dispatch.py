@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+from dbot.metrics import SEND_FAILURES, SEND_RATE_LIMITED, SEND_SECONDS
+
+__all__ = ["DigestBuffer", "NotificationDispatcher", "Message"]
+
+logger = logging.getLogger("discord_bot")
+
+# (channel_id, args, kwargs) as they would be passed to `channel.send()`
+Message = Tuple[int, Tuple[Any, ...], Dict[str, Any]]
+
+
+def _retry_after(error: discord.HTTPException) -> Tuple[float, bool]:
+    headers = getattr(error.response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("Retry-After", 1))
+    except ValueError:
+        retry_after = 1.0
+    return retry_after, headers.get("X-RateLimit-Global", "").lower() == "true"
+
+
+class NotificationDispatcher:
+    """Send messages to many channels concurrently.
+
+    Every channel has its own queue which is drained by a single task, so messages to one channel are delivered in
+    submission order, while at most `workers` sends are in flight at the same time. Rate limited (429) sends block only
+    the affected channel (or everyone for global limits) and are retried, a channel waiting out its backoff doesn't
+    hold a worker slot.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[Any]], workers: int = 16, max_attempts: int = 5):
+        """
+        :param send: coroutine function `send(channel_id, *args, **kwargs)` delivering a single message
+        :param workers: int Number of sends in flight at the same time
+        :param max_attempts: int Attempts per message before giving up on rate limits
+        """
+        self._send = send
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._queues: Dict[int, Deque[Tuple[Tuple[Any, ...], Dict[str, Any], asyncio.Future]]] = {}
+        self._blocked_until: Dict[int, float] = {}
+        self._global_blocked_until = 0.0
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        self.rate_limited = 0
+
+    def submit(self, channel_id: int, *args, **kwargs) -> asyncio.Future:
+        """Queue message for channel
+
+        :return: Future with the sent message or the raised exception
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        future = asyncio.get_event_loop().create_future()
+        if channel_id in self._queues:
+            self._queues[channel_id].append((args, kwargs, future))
+        else:
+            self._queues[channel_id] = deque([(args, kwargs, future)])
+            asyncio.ensure_future(self._drain(channel_id))
+        return future
+
+    async def fan_out(self, messages: Iterable[Message]) -> List[Any]:
+        """Send all messages and wait until every one is delivered or failed
+
+        :return: Sent messages or exceptions in the same order as given
+        """
+        messages = list(messages)
+        results = await asyncio.gather(*(self.submit(channel_id, *args, **kwargs) for channel_id, args, kwargs in messages), return_exceptions=True)
+        for (channel_id, _, _), result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Unable to send message to channel {channel_id}: {result!r}")
+        return results
+
+    async def _drain(self, channel_id: int):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                args, kwargs, future = queue.popleft()
+                try:
+                    result = await self._deliver(channel_id, args, kwargs)
+                except Exception as e:
+                    SEND_FAILURES.inc(channel=channel_id)
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self._queues[channel_id]
+            for _, _, future in queue:
+                future.cancel()
+
+    async def _deliver(self, channel_id: int, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+        for attempt in range(1, self.max_attempts + 1):
+            wait = max(self._blocked_until.get(channel_id, 0), self._global_blocked_until) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                async with self._semaphore:
+                    started = time.monotonic()
+                    result = await self._send(channel_id, *args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == self.max_attempts:
+                    raise
+                self.rate_limited += 1
+                SEND_RATE_LIMITED.inc(channel=channel_id)
+                retry_after, is_global = _retry_after(e)
+                if is_global:
+                    self._global_blocked_until = time.monotonic() + retry_after
+                else:
+                    self._blocked_until[channel_id] = time.monotonic() + retry_after
+                logger.warning(f"Rate limited while sending to channel {channel_id}, retrying in {retry_after:.2f}s ({'global' if is_global else 'channel'} limit)")
+                continue
+            latency = time.monotonic() - started
+            self.latencies.append(latency)
+            SEND_SECONDS.observe(latency, channel=channel_id)
+            logger.debug(f"Message sent to channel {channel_id} in {latency * 1000:.0f}ms")
+            return result
+
+    def latency_stats(self) -> Dict[str, float]:
+        """Send latency summary in seconds over the last sends"""
+        if not self.latencies:
+            return dict(count=0)
+        latencies = sorted(self.latencies)
+        return dict(
+            count=len(latencies),
+            p50=latencies[len(latencies) // 2],
+            p95=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            max=latencies[-1],
+        )
+
+
+class DigestBuffer:
+    """Coalesce messages for a channel arriving within `window` seconds into as few messages as possible.
+
+    The first message for a channel opens the window, when it closes all buffered embeds are merged into digest
+    embeds (up to 25 fields each) and sent through the dispatcher. Role mentions of every merged message are kept.
+    A window with a single message sends it unchanged.
+    """
+
+    MAX_FIELDS = 25
+    MENTION = re.compile(r"<@&\d+>")
+
+    def __init__(self, dispatcher: NotificationDispatcher, window: float = 30, title: str = "Notification digest"):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.title = title
+        self._buffers: Dict[int, List[Tuple[Tuple[Any, ...], Dict[str, Any]]]] = {}
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._flushes: Dict[int, asyncio.Task] = {}
+
+    def add(self, messages: Iterable[Message]) -> List[asyncio.Future]:
+        """Buffer messages until their channel's window closes
+
+        :return: Futures, one per message, done once the digest containing the message was sent (or failed)
+        """
+        loop = asyncio.get_event_loop()
+        waiters = []
+        for channel_id, args, kwargs in messages:
+            self._buffers.setdefault(channel_id, []).append((args, kwargs))
+            waiters.append(loop.create_future())
+            self._waiters.setdefault(channel_id, []).append(waiters[-1])
+            if channel_id not in self._flushes:
+                self._flushes[channel_id] = asyncio.ensure_future(self._flush_later(channel_id))
+        return waiters
+
+    @staticmethod
+    def _release(waiters: Iterable[asyncio.Future]):
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def _flush_later(self, channel_id: int):
+        await asyncio.sleep(self.window)
+        del self._flushes[channel_id]
+        waiters = self._waiters.pop(channel_id, [])
+        try:
+            await self.dispatcher.fan_out(self.merge(channel_id, self._buffers.pop(channel_id, [])))
+        except Exception as e:
+            logger.error(f"Unable to send digest to channel {channel_id}", exc_info=e)
+        finally:
+            self._release(waiters)
+
+    async def flush(self):
+        """Send everything buffered right away"""
+        flushes, self._flushes = self._flushes, {}
+        for task in flushes.values():
+            task.cancel()
+        buffers, self._buffers = self._buffers, {}
+        waiters, self._waiters = self._waiters, {}
+        try:
+            await self.dispatcher.fan_out(message for channel_id, buffered in buffers.items() for message in self.merge(channel_id, buffered))
+        finally:
+            self._release(future for channel_waiters in waiters.values() for future in channel_waiters)
+
+    def merge(self, channel_id: int, buffered: List[Tuple[Tuple[Any, ...], Dict[str, Any]]]) -> List[Message]:
+        if len(buffered) <= 1:
+            return [(channel_id, args, kwargs) for args, kwargs in buffered]
+        mentions, fields = [], []
+        for args, kwargs in buffered:
+            for mention in self.MENTION.findall(str(args[0]) if args else ""):
+                if mention not in mentions:
+                    mentions.append(mention)
+            embed = kwargs.get("embed")
+            if embed is None:
+                fields.append(dict(name="\u200b", value=str(args[0])[:1024] if args else "\u200b"))
+            elif embed.fields:
+                # Title is the only place eg. the empty medal division is mentioned
+                prefix = f"{embed.title}: " if embed.title else ""
+                fields.extend(dict(name=f"{prefix}{field.name}"[:256], value=field.value) for field in embed.fields)
+            else:
+                # Description may span several lines, which a masked link can't
+                lines = [str(embed.description or "\u200b"), embed.url, embed.footer.text]
+                fields.append(dict(name=str(embed.title or "\u200b")[:256], value="\n".join(line for line in lines if line)[:1024]))
+
+        messages = []
+        chunks = [fields[i : i + self.MAX_FIELDS] for i in range(0, len(fields), self.MAX_FIELDS)]
+        for n, chunk in enumerate(chunks, start=1):
+            title = self.title if len(chunks) == 1 else f"{self.title} ({n}/{len(chunks)})"
+            embed = discord.Embed(title=title, description=f"{len(buffered)} notifications in the last {self.window:.0f}s")
+            for field in chunk:
+                embed.add_field(inline=False, **field)
+            args = (" ".join(mentions),) if mentions and n == 1 else ()
+            messages.append((channel_id, args, dict(embed=embed)))
+        return messages
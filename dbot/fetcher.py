@@ -0,0 +1,83 @@
+from typing import Dict, NamedTuple, Optional
+
+import aiohttp
+
+__all__ = ["Fetcher", "FetchResult"]
+
+
+class FetchResult(NamedTuple):
+    url: str
+    status: int
+    body: bytes
+    not_modified: bool
+
+
+class Fetcher:
+    """Non-blocking HTTP client with a single pooled keep-alive session.
+
+    Remembers ETag/Last-Modified validators for every fetched url and sends them back as conditional request headers,
+    on `304 Not Modified` the previously received body is returned with `not_modified` set. Callers which keep their
+    own parsed copy can ask for the body not to be kept, then a 304 result has an empty body.
+    """
+
+    _session: Optional[aiohttp.ClientSession]
+    _validators: Dict[str, Dict[str, str]]
+    _bodies: Dict[str, bytes]
+
+    def __init__(self, timeout: float = 20, connect_timeout: float = 5, limit: int = 16, user_agent: str = "eRepublik discord bot"):
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._limit = limit
+        self._headers = {"User-Agent": user_agent}
+        self._session = None
+        self._validators = {}
+        self._bodies = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Session must be created inside a running event loop, so it is created on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout, headers=self._headers)
+        return self._session
+
+    async def get(self, url: str, conditional: bool = True, keep_body: bool = True) -> FetchResult:
+        """Fetch url
+
+        :param url: str Url to fetch
+        :param conditional: bool Send If-None-Match/If-Modified-Since from the previous response
+        :param keep_body: bool Keep the body to return it on 304
+        :return: FetchResult
+        :raises aiohttp.ClientError: on connection errors and non 2xx/304 responses
+        :raises asyncio.TimeoutError: if request didn't finish in time
+        """
+        headers = self._validators.get(url, {}) if conditional else {}
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304:
+                return FetchResult(url, response.status, self._bodies.get(url, b""), True)
+            response.raise_for_status()
+            body = await response.read()
+            validators = {}
+            if etag := response.headers.get("ETag"):
+                validators["If-None-Match"] = etag
+            if last_modified := response.headers.get("Last-Modified"):
+                validators["If-Modified-Since"] = last_modified
+            if validators:
+                self._validators[url] = validators
+                if keep_body:
+                    self._bodies[url] = body
+                else:
+                    self._bodies.pop(url, None)
+            else:
+                self._validators.pop(url, None)
+                self._bodies.pop(url, None)
+            return FetchResult(url, response.status, body, False)
+
+    def forget(self, url: str):
+        """Drop url's validators, so the next request isn't conditional"""
+        self._validators.pop(url, None)
+        self._bodies.pop(url, None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
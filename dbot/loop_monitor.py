@@ -0,0 +1,108 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from dbot.metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+__all__ = ["LoopMonitor", "Stall"]
+
+
+class Stall(NamedTuple):
+    # UNIX timestamp when the loop stopped running
+    started_at: float
+    # Seconds the loop was blocked, while still blocked - for how long it had been blocked when captured
+    duration: float
+    finished: bool
+    # Loop thread's stack captured while blocked, innermost frame last
+    stack: List[str]
+
+
+class LoopMonitor:
+    """Measure event loop scheduling lag and capture what blocks the loop.
+
+    A heartbeat task wakes up every `interval` seconds and records how late it woke up. A watchdog thread checks the
+    heartbeat and once the loop hasn't run it for `threshold` seconds, takes a snapshot of the loop thread's stack -
+    the code blocking the loop at that moment. The last `capacity` stalls are kept.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.5, capacity: int = 50):
+        """
+        :param interval: float Heartbeat interval in seconds
+        :param threshold: float Seconds the loop must be blocked for before its stack is captured
+        :param capacity: int Number of stalls to keep
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: Deque[float] = deque(maxlen=1000)
+        self.stalls: Deque[Stall] = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._beat = time.monotonic()
+        self._stalled = False
+        self._thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        self._stop.clear()
+        self._beat = time.monotonic()
+        self._task = loop.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._watchdog is not None and self._watchdog is not threading.current_thread():
+            self._watchdog.join()
+
+    async def _heartbeat(self):
+        self._thread_id = threading.get_ident()
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self._beat - self.interval, 0)
+            self._beat = time.monotonic()
+            self.lags.append(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            if self._stalled:
+                with self._lock:
+                    self._stalled = False
+                    if self.stalls:
+                        self.stalls[-1] = self.stalls[-1]._replace(duration=lag, finished=True)
+
+    def _watch(self):
+        while not self._stop.wait(min(self.interval, self.threshold / 2)):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked < self.threshold or self._stalled or self._thread_id is None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            del frame
+            with self._lock:
+                self._stalled = True
+                self.stalls.append(Stall(time.time() - blocked, blocked, False, stack))
+            LOOP_STALLS.inc()
+
+    def recent_stalls(self, count: int = 5) -> List[Stall]:
+        """Last captured stalls, newest first"""
+        with self._lock:
+            return list(self.stalls)[::-1][:count]
+
+    def lag_stats(self) -> Dict[str, float]:
+        """Scheduling lag summary in seconds over the last heartbeats"""
+        if not self.lags:
+            return dict(count=0)
+        lags = sorted(self.lags)
+        return dict(
+            count=len(lags),
+            p50=lags[len(lags) // 2],
+            p95=lags[min(len(lags) - 1, int(len(lags) * 0.95))],
+            max=lags[-1],
+        )
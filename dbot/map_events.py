@@ -1,6 +1,9 @@
 import feedparser
+from classifier import EventClassifier
 from constants import COUNTRIES, events
 
+classifier = EventClassifier(events)
+
 
 def main(country):
     page = 1
@@ -8,20 +11,18 @@ def main(country):
     while True:
         for entry in feedparser.parse(f"https://www.erepublik.com/en/main/news/military/all/{country}/{page}/rss").entries:
             msg = entry["summary"]
-            for kind in events:
-                match = kind.regex.search(msg)
-                if match:
-                    values = match.groupdict()
-                    if "invader" in values and not values["invader"]:
-                        values["invader"] = values["defender"]
-                    has_latvia = any("Latvia" in v for v in values.values())
-                    if has_latvia:
-                        text = kind.format.format(**dict(match.groupdict(), **{"current_country": country}))
-                        print(f"{kind.name:<20} -||- {text:<80} -||- {entry['link']:<64} -||- {entry['published']}")
-                    break
-            else:
+            classified = classifier.classify(msg)
+            if classified is None:
                 has_unknown = True
                 break
+            kind, groups = classified
+            values = dict(groups)
+            if "invader" in values and not values["invader"]:
+                values["invader"] = values["defender"]
+            has_latvia = any("Latvia" in v for v in values.values())
+            if has_latvia:
+                text = kind.format.format(**dict(groups, **{"current_country": country}))
+                print(f"{kind.name:<20} -||- {text:<80} -||- {entry['link']:<64} -||- {entry['published']}")
         else:
             page += 1
             if page > 5:
@@ -0,0 +1,248 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from aiohttp import web
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "REGISTRY",
+    "serve",
+    "timed_methods",
+    "POLL_SECONDS",
+    "POLL_PAYLOAD_BYTES",
+    "POLL_FAILURES",
+    "CHECK_BATTLES_SECONDS",
+    "CHECK_BATTLES_DIVISIONS",
+    "DB_QUERY_SECONDS",
+    "SEND_SECONDS",
+    "SEND_RATE_LIMITED",
+    "SEND_FAILURES",
+    "EPIC_ALERT_LAG_SECONDS",
+    "LOOP_LAG_SECONDS",
+    "LOOP_STALLS",
+    "RSS_CACHE_REQUESTS",
+    "RSS_POLL_INTERVAL_SECONDS",
+]
+
+T = TypeVar("T")
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        """
+        :param name: str Metric name, eg. `dbot_poll_seconds`
+        :param documentation: str HELP text
+        :param labelnames: Names of labels every observation must have
+        :param registry: Registry to render the metric in, None to not register it
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> (per bucket counts, sum)
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0])
+            counts, total = self._values[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the duration of the block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], [0.0]))
+        return sum(counts)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bucket)}"'
+                samples.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            samples.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            samples.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return samples
+
+
+def timed_methods(histogram: Histogram, label: str = "method", exclude: Sequence[str] = ()) -> Callable[[T], T]:
+    """Class decorator observing the duration of every public method call in `histogram`, labelled by method name
+
+    Only the outermost call is observed, methods called by another timed method are part of its duration.
+
+    :param exclude: Names of public methods not to time, eg. cheap in-memory lookups
+    """
+    local = threading.local()
+
+    def wrap(method: Callable, name: str) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if getattr(local, "active", False):
+                return method(*args, **kwargs)
+            local.active = True
+            try:
+                with histogram.time(**{label: name}):
+                    return method(*args, **kwargs)
+            finally:
+                local.active = False
+
+        return wrapper
+
+    def decorate(cls: T) -> T:
+        for name, attr in list(vars(cls).items()):
+            if not name.startswith("_") and name not in exclude and callable(attr):
+                setattr(cls, name, wrap(attr, name))
+        return cls
+
+    return decorate
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    """Serve registry's metrics on http://host:port/metrics
+
+    :return: Runner to `cleanup()` when done
+    """
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+POLL_SECONDS = Histogram("dbot_poll_seconds", "Time to fetch a campaignsJson or RSS feed", ["source"])
+POLL_PAYLOAD_BYTES = Histogram("dbot_poll_payload_bytes", "Size of fetched response bodies", ["source"], buckets=(1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7))
+POLL_FAILURES = Counter("dbot_poll_failures_total", "Failed campaignsJson or RSS feed fetches", ["source"])
+CHECK_BATTLES_SECONDS = Histogram("dbot_check_battles_seconds", "Time to check a campaignsJson snapshot and queue its notifications")
+CHECK_BATTLES_DIVISIONS = Gauge("dbot_check_battles_divisions", "Divisions in the last checked snapshot, all running ones and the changed ones that were scanned", ["scope"])
+DB_QUERY_SECONDS = Histogram("dbot_db_query_seconds", "DiscordDB method call duration", ["method"], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+SEND_SECONDS = Histogram("dbot_send_seconds", "Discord message send latency", ["channel"])
+SEND_RATE_LIMITED = Counter("dbot_send_rate_limited_total", "Discord 429 responses while sending", ["channel"])
+SEND_FAILURES = Counter("dbot_send_failures_total", "Messages which could not be sent", ["channel"])
+EPIC_ALERT_LAG_SECONDS = Histogram(
+    "dbot_epic_alert_lag_seconds",
+    "Time from the campaignsJson update first showing an epic battle to all its alerts being sent, including queueing, rate limit backoff and digest windows",
+)
+LOOP_LAG_SECONDS = Histogram("dbot_loop_lag_seconds", "Event loop scheduling lag", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_STALLS = Counter("dbot_loop_stalls_total", "Times the event loop was blocked for longer than the stall threshold")
+RSS_CACHE_REQUESTS = Counter(
+    "dbot_rss_cache_requests_total", "Fetched RSS feeds by country, hits came back as 304 Not Modified or with unchanged content and weren't parsed", ["country", "result"]
+)
+RSS_POLL_INTERVAL_SECONDS = Gauge("dbot_rss_poll_interval_seconds", "Current RSS feed poll interval by country", ["country"])
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Generic, Optional, TypeVar
+
+__all__ = ["SnapshotProvider", "SnapshotUnavailable"]
+
+logger = logging.getLogger("discord_bot")
+
+T = TypeVar("T")
+
+
+class SnapshotUnavailable(Exception):
+    def __init__(self, message: str, retry_at: float):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+
+class SnapshotProvider(Generic[T]):
+    """Cache a periodically refreshed snapshot (eg. campaignsJson) shared by all readers.
+
+    * Concurrent callers share a single in-flight fetch.
+    * Readers allowing stale data get the last good snapshot right away while a refresh runs in the background.
+    * Failed fetches are retried with exponential backoff, after `failure_threshold` consecutive failures the circuit
+      opens and no fetches are made for `cooldown` seconds.
+    """
+
+    value: Optional[T]
+    fetched_at: float
+    expires_at: float
+
+    def __init__(
+        self,
+        fetch: Callable[[], Awaitable[T]],
+        expires: Callable[[T, float], float],
+        min_interval: float = 10,
+        backoff: float = 2,
+        max_backoff: float = 120,
+        failure_threshold: int = 5,
+        cooldown: float = 300,
+        name: str = "snapshot",
+    ):
+        """
+        :param fetch: coroutine function returning a new snapshot, any raised exception counts as a failure
+        :param expires: function (snapshot, fetch timestamp) -> timestamp until which the snapshot is fresh
+        :param min_interval: Minimum seconds between successful fetches
+        """
+        self._fetch = fetch
+        self._expires = expires
+        self.min_interval = min_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.name = name
+        self.value = None
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self.failures = 0
+        self.next_attempt = 0.0
+        self._inflight: Optional[asyncio.Future] = None
+
+    @property
+    def circuit_open(self) -> bool:
+        return self.failures >= self.failure_threshold and time.time() < self.next_attempt
+
+    async def get(self, allow_stale: bool = True) -> T:
+        """Get snapshot
+
+        :param allow_stale: Return the last good snapshot instead of waiting for a running refresh
+        :raises SnapshotUnavailable: if there is no usable snapshot and fetching is backing off
+        :raises Exception: whatever the fetch raised, if the caller waited for it
+        """
+        now = time.time()
+        if self.value is not None and now < self.expires_at:
+            return self.value
+        if self._inflight is None and now >= self.next_attempt:
+            self._inflight = asyncio.ensure_future(self._refresh())
+            self._inflight.add_done_callback(self._log_failure)
+        if self._inflight is not None and (self.value is None or not allow_stale):
+            return await asyncio.shield(self._inflight)
+        if self.value is not None and allow_stale:
+            return self.value
+        state = "circuit open" if self.circuit_open else "backing off"
+        raise SnapshotUnavailable(f"No fresh {self.name} available, {state} after {self.failures} failures", self.next_attempt)
+
+    async def _refresh(self) -> T:
+        try:
+            value = await self._fetch()
+        except Exception:
+            self.failures += 1
+            delay = min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+            if self.failures >= self.failure_threshold:
+                delay = max(delay, self.cooldown)
+            self.next_attempt = time.time() + delay
+            raise
+        else:
+            now = time.time()
+            self.failures = 0
+            self.value = value
+            self.fetched_at = now
+            self.expires_at = max(self._expires(value, now), now + self.min_interval)
+            self.next_attempt = now + self.min_interval
+            return value
+        finally:
+            self._inflight = None
+
+    def _log_failure(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"Unable to refresh {self.name} ({self.failures} consecutive failures, next attempt in {self.next_attempt - time.time():.0f}s): {future.exception()!r}")
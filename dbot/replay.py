@@ -0,0 +1,132 @@
+"""Replay a recorded archive through the battle and RSS watchers with a fake Discord transport
+
+Record with `RECORD_DIR=debug/recordings`, then replay (60x faster than real time by default):
+
+Usage: PYTHONPATH=dbot python -m dbot.replay ARCHIVE [--speed 60] [--channels 1] [--latency 0.05] [--db :memory:]
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import discord
+from erepublik.constants import COUNTRIES
+
+from dbot.archive import ArchiveEntry, read_archive
+from dbot.snapshot import parse_campaigns
+
+__all__ = ["FakeChannel", "FakeTransport", "SentMessage", "replay"]
+
+
+class SentMessage(NamedTuple):
+    channel_id: int
+    content: Optional[str]
+    embed: Optional[discord.Embed]
+
+
+class FakeChannel:
+    def __init__(self, transport: "FakeTransport", channel_id: int):
+        self.transport = transport
+        self.id = channel_id
+
+    async def send(self, content: str = None, *, embed: discord.Embed = None, **kwargs) -> SentMessage:
+        if self.transport.latency:
+            await asyncio.sleep(self.transport.latency)
+        message = SentMessage(self.id, content, embed)
+        self.transport.sent.append(message)
+        return message
+
+
+class FakeTransport:
+    """Stand-in for the Discord bot - every channel exists and sending a message only stores it"""
+
+    def __init__(self, latency: float = 0.0):
+        """
+        :param latency: float Seconds every send takes
+        """
+        self.latency = latency
+        self.sent: List[SentMessage] = []
+        self._channels: Dict[int, FakeChannel] = {}
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        if channel_id not in self._channels:
+            self._channels[channel_id] = FakeChannel(self, channel_id)
+        return self._channels[channel_id]
+
+
+async def replay(watchers, entries: List[ArchiveEntry], speed: float = 60.0) -> Dict[str, Any]:
+    """Feed recorded payloads to the watchers, keeping the recorded spacing divided by `speed`
+
+    :param watchers: Watchers cog running on a FakeTransport instead of the bot
+    :param entries: Recorded payloads, ordered by timestamp
+    :param speed: float Replay speed-up, 0 replays without waiting
+    :return: Replay statistics
+    """
+    durations = defaultdict(list)
+    started = time.monotonic()
+    first_ts = entries[0].timestamp if entries else 0
+    for entry in entries:
+        if speed:
+            wait = (entry.timestamp - first_ts) / speed - (time.monotonic() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        tick_started = time.perf_counter()
+        if entry.kind == "campaigns":
+            await watchers.check_battle_page(parse_campaigns(entry.body), int(entry.timestamp))
+        elif entry.kind == "rss":
+            await watchers.process_rss_feed(COUNTRIES[int(entry.key)], entry.body)
+        else:
+            continue
+        durations[entry.kind].append(time.perf_counter() - tick_started)
+    if watchers.digest is not None:
+        await watchers.digest.flush()
+
+    stats = dict(entries=len(entries), recorded_s=entries[-1].timestamp - first_ts if entries else 0, wall_s=time.monotonic() - started)
+    for kind, kind_durations in durations.items():
+        kind_durations.sort()
+        stats[f"{kind}_ticks"] = len(kind_durations)
+        stats[f"{kind}_p50_ms"] = kind_durations[len(kind_durations) // 2] * 1e3
+        stats[f"{kind}_max_ms"] = kind_durations[-1] * 1e3
+    return stats
+
+
+async def run(archive: str, speed: float, channels: int, latency: float):
+    # Imported late, base module opens the database and changes working directory on import
+    from dbot.base import DB, NOTIFICATION_KINDS
+    from dbot.discord_bot import Watchers
+
+    entries = read_archive(archive)
+    transport = FakeTransport(latency)
+    watchers = Watchers(transport)
+    # Same as a production start - only events after the recording started are new
+    for country_id in COUNTRIES:
+        await DB.set_rss_feed_timestamp(country_id, entries[0].timestamp if entries else time.time())
+    for n in range(channels):
+        for kind in NOTIFICATION_KINDS:
+            await DB.add_notification_channel(n, n * len(NOTIFICATION_KINDS) + NOTIFICATION_KINDS.index(kind) + 1, kind)
+
+    stats = await replay(watchers, entries, speed)
+    stats.update(messages_sent=len(transport.sent), send_latency=watchers.dispatcher.latency_stats())
+    for name, value in stats.items():
+        print(f"{name:<24} {value}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay recorded campaignsJson and RSS payloads")
+    parser.add_argument("archive", help="Recording created with RECORD_DIR")
+    parser.add_argument("--speed", type=float, default=60.0, help="Replay speed-up, 0 to replay as fast as possible")
+    parser.add_argument("--channels", type=int, default=1, help="Notification channels per kind")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each fake send takes")
+    parser.add_argument("--db", default=":memory:", help="Database to replay against, in-memory by default")
+    args = parser.parse_args(args)
+    archive = os.path.abspath(args.archive)
+    # Replays must not touch the real database unless asked to, base module reads DB_NAME on import
+    os.environ["DB_NAME"] = args.db
+    os.environ.pop("RECORD_DIR", None)
+    asyncio.run(run(archive, args.speed, args.channels, args.latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import asyncio
+import email.utils
+import hashlib
+import heapq
+import io
+import math
+import random
+import time
+from collections import defaultdict, deque
+from typing import AsyncGenerator, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+import feedparser
+from erepublik.constants import Country
+
+from dbot.fetcher import Fetcher, FetchResult
+from dbot.metrics import POLL_FAILURES, POLL_PAYLOAD_BYTES, POLL_SECONDS, RSS_CACHE_REQUESTS, RSS_POLL_INTERVAL_SECONDS
+
+__all__ = ["FeedCache", "FeedEntry", "RssPoller", "RssScheduler", "iter_feed_entries", "new_feed_entries", "rss_link"]
+
+
+def rss_link(country: Country, page: int = 1) -> str:
+    return f"https://www.erepublik.com/en/main/news/military/all/{country.link}/{page}/rss"
+
+
+class FeedEntry(NamedTuple):
+    # UNIX timestamp as `time.mktime(feedparser_entry["published_parsed"])` - how stored watermarks were calculated
+    timestamp: float
+    title: str
+    link: str
+    # Event message, may contain an <a href> tag
+    summary: str
+
+    @property
+    def unix_timestamp(self) -> float:
+        """Real UNIX timestamp, `timestamp` is off by the host's UTC offset as `time.mktime` read UTC as local standard time"""
+        return self.timestamp - time.timezone
+
+
+def _entry_timestamp(published: str) -> float:
+    return time.mktime(email.utils.parsedate_to_datetime(published).utctimetuple())
+
+
+def iter_feed_entries(feed: bytes) -> Iterator[FeedEntry]:
+    """Stream RSS 2.0 items in document order (newest first in eRepublik feeds) without building the whole document
+
+    :raises xml.etree.ElementTree.ParseError: if feed isn't well-formed XML, items before the error are yielded
+    """
+    for _, element in ElementTree.iterparse(io.BytesIO(feed)):
+        if element.tag != "item":
+            continue
+        published = element.findtext("pubDate")
+        if published:
+            yield FeedEntry(
+                _entry_timestamp(published),
+                (element.findtext("title") or "").strip(),
+                (element.findtext("link") or "").strip(),
+                (element.findtext("description") or "").strip(),
+            )
+        element.clear()
+
+
+def _feedparser_entries(feed: bytes) -> Iterator[FeedEntry]:
+    for entry in feedparser.parse(feed).entries:
+        if entry.get("published_parsed"):
+            yield FeedEntry(time.mktime(entry["published_parsed"]), entry.get("title", ""), entry.get("link", ""), entry.get("summary", ""))
+
+
+def new_feed_entries(feed: bytes, after: float) -> List[FeedEntry]:
+    """Entries published after `after`, oldest first
+
+    Reading stops at the first entry which isn't newer, so usually only the first item or two are parsed. Feeds
+    which aren't well-formed XML, or whose new entries contain markup, are parsed with feedparser instead - it
+    sanitizes the HTML and resolves relative links, which the event patterns expect.
+
+    :param feed: RSS feed, newest entry first
+    :param after: float Timestamp of the latest already processed entry
+    """
+    entries = []
+    try:
+        for entry in iter_feed_entries(feed):
+            if entry.timestamp <= after:
+                break
+            entries.append(entry)
+    except ElementTree.ParseError:
+        entries = None
+    if entries is None or any("<" in entry.summary for entry in entries):
+        entries = [entry for entry in _feedparser_entries(feed) if entry.timestamp > after]
+    return entries[::-1]
+
+
+class FeedCache:
+    """Content hash of every country's last fetched feed with per-country hit/miss counts.
+
+    ETag/Last-Modified validators are kept by the Fetcher, this catches servers which don't send them or send the
+    same feed with new validators. A new hash only counts as seen once the feed was processed, see `commit()`.
+    """
+
+    def __init__(self):
+        self._digests: Dict[int, bytes] = {}
+        self._pending: Dict[int, bytes] = {}
+        self.hits: Dict[int, int] = defaultdict(int)
+        self.misses: Dict[int, int] = defaultdict(int)
+
+    def check(self, country: Country, response: FetchResult) -> FetchResult:
+        """Mark response `not_modified` if its content is the same as the last processed one
+
+        :param country: Country the feed belongs to
+        :param response: Fetched feed
+        :return: response, with `not_modified` set for cache hits
+        """
+        if not response.not_modified:
+            digest = hashlib.blake2b(response.body, digest_size=16).digest()
+            if self._digests.get(country.id) == digest:
+                response = response._replace(not_modified=True)
+            else:
+                self._pending[country.id] = digest
+        if response.not_modified:
+            self.hits[country.id] += 1
+        else:
+            self.misses[country.id] += 1
+        RSS_CACHE_REQUESTS.inc(country=country.id, result="hit" if response.not_modified else "miss")
+        return response
+
+    def commit(self, country: Country):
+        """Remember the last checked content of the country's feed as processed"""
+        if country.id in self._pending:
+            self._digests[country.id] = self._pending.pop(country.id)
+
+    def forget(self, country: Country):
+        """Drop the country's feed hash, so the next fetch is processed whatever it contains"""
+        self._digests.pop(country.id, None)
+        self._pending.pop(country.id, None)
+
+
+class RssPoller:
+    """Fetch country military news feeds concurrently.
+
+    At most `concurrency` requests are in flight in total and at most `per_host` towards a single host,
+    consecutive requests to the same host are started at least `host_delay` seconds apart.
+    """
+
+    def __init__(self, fetcher: Fetcher, concurrency: int = 10, per_host: int = 4, host_delay: float = 0.05):
+        self.fetcher = fetcher
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.host_delay = host_delay
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._host_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._host_last_request: Dict[str, float] = defaultdict(float)
+        self.cache = FeedCache()
+
+    async def _polite(self, host: str):
+        async with self._host_locks[host]:
+            wait = self._host_last_request[host] + self.host_delay - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._host_last_request[host] = time.monotonic()
+
+    async def fetch(self, country: Country, semaphore: asyncio.Semaphore) -> Tuple[Country, Union[FetchResult, Exception]]:
+        url = rss_link(country)
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.per_host)
+        async with semaphore, self._host_semaphores[host]:
+            await self._polite(host)
+            try:
+                with POLL_SECONDS.time(source="rss"):
+                    response = await self.fetcher.get(url)
+            except Exception as e:
+                POLL_FAILURES.inc(source="rss")
+                return country, e
+            if not response.not_modified:
+                POLL_PAYLOAD_BYTES.observe(len(response.body), source="rss")
+            return country, self.cache.check(country, response)
+
+    def processed(self, country: Country):
+        """Mark the last polled feed of the country as processed, the same content will be `not_modified` from now on"""
+        self.cache.commit(country)
+
+    def failed(self, country: Country):
+        """Processing the last polled feed of the country failed, the next poll returns the full feed again"""
+        self.cache.forget(country)
+        self.fetcher.forget(rss_link(country))
+
+    async def poll(self, countries: Iterable[Country]) -> AsyncGenerator[Tuple[Country, Union[FetchResult, Exception]], None]:
+        """Fetch every country's feed, yielding (country, response or raised exception) in order of completion
+
+        Responses which are `not_modified` - either 304 or the same content as the last time - don't need parsing.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self.fetch(country, semaphore)) for country in countries]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class RssScheduler:
+    """Decide when to poll each country's feed, given a global request budget.
+
+    Every country's event rate is estimated from the event timestamps processed within the last `window` seconds
+    (plus `prior_events`, so countries without events keep a small rate). The budget of `budget` requests per second
+    is split in proportion to the square root of the weighted rates - the split with the lowest average delay between
+    an event and the poll which finds it - and every country's interval is kept between `min_interval` and
+    `max_interval`. Intervals are jittered by 10%, so countries with the same interval don't all come due together.
+    """
+
+    def __init__(
+        self,
+        country_ids: Iterable[int],
+        budget: float,
+        min_interval: float = 60,
+        max_interval: float = 30 * 60,
+        window: float = 6 * 60 * 60,
+        prior_events: float = 0.5,
+        weights: Optional[Dict[int, float]] = None,
+        now: float = None,
+    ):
+        """
+        :param country_ids: Countries to poll, every one is due right away
+        :param budget: float Requests per second for all countries together
+        :param min_interval: float Shortest interval between two polls of a country
+        :param max_interval: float Longest interval between two polls of a country
+        :param window: float Seconds of processed events the rate estimate is based on
+        :param prior_events: float Events assumed in every window, the rate estimate of dormant countries
+        :param weights: Country ID -> importance multiplier of its rate, 1 by default
+        :param now: float Current UNIX timestamp
+        """
+        now = time.time() if now is None else now
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window = window
+        self.prior_events = prior_events
+        self.weights = weights or {}
+        self._events: Dict[int, Deque[float]] = {country_id: deque() for country_id in country_ids}
+        self._next: Dict[int, float] = {country_id: now for country_id in self._events}
+        self._heap: List[Tuple[float, int]] = [(now, country_id) for country_id in self._events]
+        heapq.heapify(self._heap)
+        self._scale = 0.0
+        # Budget split is redone when new events are recorded and at least every `min_interval` seconds
+        self._planned_at: Optional[float] = None
+        self._random = random.Random()
+
+    def rate(self, country_id: int, now: float) -> float:
+        """Estimated events per second"""
+        events = self._events[country_id]
+        while events and events[0] < now - self.window:
+            events.popleft()
+        return (len(events) + self.prior_events) / self.window
+
+    def _demand(self, country_id: int, now: float) -> float:
+        return math.sqrt(self.weights.get(country_id, 1) * self.rate(country_id, now))
+
+    def _poll_rate(self, demand: float, scale: float) -> float:
+        return min(max(scale * demand, 1 / self.max_interval), 1 / self.min_interval)
+
+    def _plan(self, now: float):
+        """Find the largest scale turning demands into poll rates which fit in the budget"""
+        demands = [self._demand(country_id, now) for country_id in self._events]
+        low, high = 0.0, 1.0
+        while sum(self._poll_rate(demand, high) for demand in demands) < self.budget and high < 1e12:
+            low, high = high, high * 2
+        for _ in range(50):
+            middle = (low + high) / 2
+            if sum(self._poll_rate(demand, middle) for demand in demands) > self.budget:
+                high = middle
+            else:
+                low = middle
+        self._scale = low
+        self._planned_at = now
+
+    def interval(self, country_id: int, now: float) -> float:
+        """Seconds until the country should be polled again"""
+        return 1 / self._poll_rate(self._demand(country_id, now), self._scale)
+
+    def _schedule(self, country_id: int, now: float):
+        interval = self.interval(country_id, now)
+        RSS_POLL_INTERVAL_SECONDS.set(interval, country=country_id)
+        self._next[country_id] = now + interval * self._random.uniform(0.9, 1.1)
+        heapq.heappush(self._heap, (self._next[country_id], country_id))
+
+    def next_due(self) -> float:
+        """UNIX timestamp when the next country is due"""
+        while self._heap[0][0] != self._next[self._heap[0][1]]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def due(self, now: float = None) -> List[int]:
+        """IDs of countries due for polling, they are rescheduled as if polled right away"""
+        now = time.time() if now is None else now
+        if self._planned_at is None or now - self._planned_at >= self.min_interval:
+            self._plan(now)
+        due = []
+        while self.next_due() <= now:
+            _, country_id = heapq.heappop(self._heap)
+            due.append(country_id)
+            self._schedule(country_id, now)
+        return due
+
+    def record(self, country_id: int, timestamps: Iterable[float], now: float = None):
+        """Add processed event timestamps and reschedule the country counting from now
+
+        :param country_id: int Country whose feed was just polled
+        :param timestamps: Timestamps of the new events found in the feed
+        :param now: float Time the feed was polled
+        """
+        now = time.time() if now is None else now
+        timestamps = sorted(timestamps)
+        self._events[country_id].extend(timestamps)
+        if timestamps:
+            self._planned_at = None
+            self._schedule(country_id, now)
@@ -0,0 +1,287 @@
+import json
+from bisect import bisect_right
+from operator import itemgetter
+from typing import Any, Collection, Dict, Generator, List, NamedTuple, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from dbot.constants import UTF_FLAG, DivisionData
+
+__all__ = ["ColumnarSnapshot", "DivisionState", "EmptyMedalIndex", "SnapshotDelta", "SnapshotDiffer", "parse_campaigns", "s_to_human"]
+
+BATTLE_FIELDS = ("id", "start", "zone_id", "region", "inv", "def", "div")
+DIVISION_FIELDS = ("id", "div", "end", "epic", "intensity_scale", "wall")
+
+
+def s_to_human(seconds: Union[int, float]) -> str:
+    seconds = int(seconds)
+    h = seconds // 3600
+    m = (seconds - (h * 3600)) // 60
+    s = seconds % 60
+    return f"{h:01d}:{m:02d}:{s:02d}"
+
+
+def _compact_object(pairs: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    obj = dict(pairs)
+    if "wall" in obj and "epic" in obj and "div" in obj:
+        division = {key: obj[key] for key in DIVISION_FIELDS if key in obj}
+        division["wall"] = {"for": obj["wall"]["for"], "dom": obj["wall"]["dom"]}
+        return division
+    if "zone_id" in obj and "start" in obj and "div" in obj:
+        battle = {key: obj[key] for key in BATTLE_FIELDS if key in obj}
+        battle["region"] = {"name": obj["region"]["name"]}
+        battle["inv"] = {"id": obj["inv"]["id"]}
+        battle["def"] = {"id": obj["def"]["id"]}
+        return battle
+    if "battles" in obj and "last_updated" in obj:
+        return {"battles": obj["battles"], "last_updated": obj["last_updated"]}
+    return obj
+
+
+def parse_campaigns(body: Union[bytes, str]) -> Dict[str, Any]:
+    """Parse campaignsJson response keeping only the fields used by the battle watchers
+
+    Every battle and division is reduced as soon as the decoder has read it, so the complete response tree is never
+    held in memory at once.
+
+    :raises json.JSONDecodeError: if body is not valid JSON
+    """
+    return json.loads(body, object_pairs_hook=_compact_object)
+
+
+class DivisionState(NamedTuple):
+    battle_id: int
+    start: int
+    division: int
+    dom: float
+    wall_for: int
+    epic: int
+    intensity_scale: str
+
+
+class ColumnarSnapshot:
+    """Running divisions of a campaignsJson snapshot stored column-wise, one row per division.
+
+    Rows are ordered by battle start. Detection rules are evaluated as array masks over all rows at once and
+    DivisionData is only built for the rows that are yielded.
+    """
+
+    now: int
+    div_id: np.ndarray
+    battle_id: np.ndarray
+    division: np.ndarray
+    dom: np.ndarray
+    wall_for: np.ndarray
+    epic: np.ndarray
+    start: np.ndarray
+
+    def __init__(self, battle_json: Dict[str, Dict[str, Any]], now: int):
+        self.now = now
+        self.battles: List[Dict[str, Any]] = [battle for battle in sorted(battle_json.values(), key=itemgetter("start")) if battle["start"] <= now]
+        battle_idx, div_id, division, dom, wall_for, epic, intensity_scale = [], [], [], [], [], [], []
+        for idx, battle in enumerate(self.battles):
+            for div in battle["div"].values():
+                if div["end"]:
+                    continue
+                battle_idx.append(idx)
+                div_id.append(div["id"])
+                division.append(div["div"])
+                dom.append(div["wall"]["dom"])
+                wall_for.append(div["wall"]["for"])
+                epic.append(div["epic"])
+                intensity_scale.append(div["intensity_scale"])
+        self.battle_idx = np.array(battle_idx, dtype=np.int32)
+        self.div_id = np.array(div_id, dtype=np.int64)
+        self.division = np.array(division, dtype=np.int16)
+        self.dom = np.array(dom, dtype=np.float64)
+        self.wall_for = np.array(wall_for, dtype=np.int32)
+        self.epic = np.array(epic, dtype=np.int16)
+        self.intensity_scale = intensity_scale
+        self.battle_id = np.array([battle["id"] for battle in self.battles], dtype=np.int64)[self.battle_idx]
+        self.start = np.array([battle["start"] for battle in self.battles], dtype=np.int64)[self.battle_idx]
+        self.defender = np.array([battle["def"]["id"] for battle in self.battles], dtype=np.int32)[self.battle_idx]
+
+    def __len__(self) -> int:
+        return len(self.div_id)
+
+    @property
+    def round_time_s(self) -> np.ndarray:
+        return self.now - self.start
+
+    @property
+    def empty_tie_mask(self) -> np.ndarray:
+        return self.dom == 50
+
+    @property
+    def empty_full_mask(self) -> np.ndarray:
+        return self.dom == 100
+
+    @property
+    def epic_mask(self) -> np.ndarray:
+        return self.epic > 1
+
+    @property
+    def steal_mask(self) -> np.ndarray:
+        return self.dom >= 66.8
+
+    def states(self) -> Dict[int, DivisionState]:
+        columns = (self.battle_id, self.start, self.division, self.dom, self.wall_for, self.epic)
+        return {div_id: DivisionState(*row, intensity) for div_id, *row, intensity in zip(self.div_id.tolist(), *(column.tolist() for column in columns), self.intensity_scale)}
+
+    def division_data(self, row: int, sides: List[str], **extra) -> DivisionData:
+        battle = self.battles[self.battle_idx[row]]
+        return self._division_data(battle, int(self.div_id[row]), int(self.now - self.start[row]), sides, extra)
+
+    @staticmethod
+    def _division_data(battle: Dict[str, Any], div_id: int, round_time_s: int, sides: List[str], extra: Dict[str, Any]) -> DivisionData:
+        return DivisionData(
+            region=battle["region"]["name"],
+            round_time=s_to_human(round_time_s),
+            round_time_s=round_time_s,
+            sides=sides,
+            url=f"https://www.erepublik.com/en/military/battlefield/{battle['id']}",
+            zone_id=battle["zone_id"],
+            div_id=div_id,
+            extra=extra,
+        )
+
+    def events(self, div_ids: Optional[Collection[int]] = None) -> Generator[Tuple[str, int, DivisionData], None, None]:
+        """Yield (kind, division, data) for every row matching the empty/epic/steal rules
+
+        :param div_ids: Only check these division IDs
+        """
+        tie, full, epic, steal = self.empty_tie_mask, self.empty_full_mask, self.epic_mask, self.steal_mask
+        matching = tie | full | epic | steal
+        if div_ids is not None:
+            matching &= np.isin(self.div_id, np.fromiter(div_ids, dtype=np.int64, count=len(div_ids)))
+        rows = np.flatnonzero(matching)
+        columns = (
+            self.battle_idx[rows],
+            self.div_id[rows],
+            self.division[rows],
+            self.round_time_s[rows],
+            self.epic[rows],
+            self.defender[rows] == self.wall_for[rows],
+            tie[rows],
+            full[rows],
+            epic[rows],
+            steal[rows],
+        )
+        for row, (battle_idx, div_id, division, round_time_s, epic_type, defender_wall, is_tie, is_full, is_epic, is_steal) in zip(
+            rows.tolist(), zip(*(column.tolist() for column in columns))
+        ):
+            battle = self.battles[battle_idx]
+            invader_flag = UTF_FLAG[battle["inv"]["id"]]
+            defender_flag = UTF_FLAG[battle["def"]["id"]]
+            wall_flag = invader_flag if defender_wall else defender_flag
+            if is_tie:
+                yield "empty", division, self._division_data(battle, div_id, round_time_s, [invader_flag, defender_flag], {})
+            if is_full:
+                yield "empty", division, self._division_data(battle, div_id, round_time_s, [wall_flag], {})
+            if is_epic:
+                extra = dict(intensity_scale=self.intensity_scale[row], epic_type=epic_type)
+                yield "epic", division, self._division_data(battle, div_id, round_time_s, [invader_flag, defender_flag], extra)
+            if is_steal:
+                yield "steal", division, self._division_data(battle, div_id, round_time_s, [wall_flag], {})
+
+
+class EmptyMedalIndex:
+    """Possibly empty medals of a snapshot per division, ordered by battle start - longest running round first.
+
+    Built once per snapshot, so a query for divisions running at least N minutes is a dictionary lookup and a binary
+    search over the round start times. Round times are calculated at query time.
+    """
+
+    def __init__(self, snapshot: ColumnarSnapshot):
+        self.now = snapshot.now
+        self._starts: Dict[int, List[int]] = {}
+        self._entries: Dict[int, List[Tuple[Dict[str, Any], int, List[str]]]] = {}
+        tie, full = snapshot.empty_tie_mask, snapshot.empty_full_mask
+        rows = np.flatnonzero(tie | full)
+        columns = (snapshot.battle_idx[rows], snapshot.div_id[rows], snapshot.division[rows], snapshot.start[rows], snapshot.defender[rows] == snapshot.wall_for[rows], tie[rows])
+        for battle_idx, div_id, division, start, defender_wall, is_tie in zip(*(column.tolist() for column in columns)):
+            battle = snapshot.battles[battle_idx]
+            invader_flag, defender_flag = UTF_FLAG[battle["inv"]["id"]], UTF_FLAG[battle["def"]["id"]]
+            sides = [invader_flag, defender_flag] if is_tie else [invader_flag if defender_wall else defender_flag]
+            self._starts.setdefault(division, []).append(start)
+            self._entries.setdefault(division, []).append((battle, div_id, sides))
+
+    def _matching(self, division: int, min_round_time_s: int, now: int) -> int:
+        return bisect_right(self._starts.get(division, []), now - min_round_time_s)
+
+    def count(self, division: int, min_round_time_s: int = 0, now: Optional[int] = None) -> int:
+        """Number of possibly empty medals in division with round running at least `min_round_time_s` seconds"""
+        return self._matching(division, min_round_time_s, self.now if now is None else now)
+
+    def query(self, division: int, min_round_time_s: int = 0, now: Optional[int] = None, offset: int = 0, limit: Optional[int] = None) -> List[DivisionData]:
+        """Possibly empty medals in division with round running at least `min_round_time_s` seconds
+
+        :param division: int Division - 1, 2, 3, 4 or 11
+        :param min_round_time_s: int Minimum round time in seconds
+        :param now: int Timestamp to calculate round times against, defaults to the snapshot's time
+        :param offset: int Number of matching entries to skip
+        :param limit: int Maximum number of entries to return
+        """
+        now = self.now if now is None else now
+        end = self._matching(division, min_round_time_s, now)
+        if limit is not None:
+            end = min(end, offset + limit)
+        starts, entries = self._starts.get(division, []), self._entries.get(division, [])
+        return [ColumnarSnapshot._division_data(battle, div_id, now - start, list(sides), {}) for start, (battle, div_id, sides) in zip(starts[offset:end], entries[offset:end])]
+
+
+class SnapshotDelta(NamedTuple):
+    added: Set[int]
+    ended: Set[int]
+    changed: Set[int]
+    # Divisions whose round time went over a watched threshold since the previous snapshot
+    crossed: Set[int]
+
+    @property
+    def active(self) -> Set[int]:
+        """Running divisions which have to be checked again"""
+        return self.added | self.changed | self.crossed
+
+
+class SnapshotDiffer:
+    """Compare campaignsJson battles with the previous snapshot.
+
+    `diff()` only calculates the delta, the new snapshot replaces the previous one after `commit()`, so a failed tick
+    is retried with the same delta on the next snapshot.
+    """
+
+    _previous: Dict[int, DivisionState]
+    _previous_ts: Optional[int]
+
+    def __init__(self, *thresholds: int):
+        self.thresholds = thresholds
+        self._previous = {}
+        self._previous_ts = None
+        self._pending = None
+
+    def diff(self, battle_json: Dict[str, Dict[str, Any]], now: int) -> SnapshotDelta:
+        return self.diff_snapshot(ColumnarSnapshot(battle_json, now))
+
+    def diff_snapshot(self, snapshot: ColumnarSnapshot) -> SnapshotDelta:
+        current, now = snapshot.states(), snapshot.now
+        previous = self._previous
+        added = current.keys() - previous.keys()
+        ended = previous.keys() - current.keys()
+        changed = {div_id for div_id in current.keys() & previous.keys() if current[div_id] != previous[div_id]}
+        crossed = set()
+        if self._previous_ts is not None and self.thresholds:
+            for div_id in current.keys() - added - changed:
+                round_start = current[div_id].start
+                if any(self._previous_ts < round_start + threshold <= now for threshold in self.thresholds):
+                    crossed.add(div_id)
+        self._pending = (current, now)
+        return SnapshotDelta(set(added), set(ended), changed, crossed)
+
+    def commit(self):
+        """Make the last diffed snapshot the one to compare against"""
+        if self._pending is not None:
+            self._previous, self._previous_ts = self._pending
+            self._pending = None
+
+    def reset(self):
+        self._previous, self._previous_ts, self._pending = {}, None, None
@@ -1,7 +1,24 @@
+import asyncio
+import copy
+import functools
+import json
+import os
+import random
 import re
+import sqlite3
+import tempfile
+import time
 import unittest
+from types import SimpleNamespace
+from unittest import mock
+from xml.etree import ElementTree
 
-from dbot import constants, db
+import aiohttp
+import discord
+import sqlite_utils
+from aiohttp import web
+
+from dbot import archive, async_db, benchmark, classifier, constants, db, deadlines, dispatch, fetcher, loop_monitor, metrics, provider, replay, rss, snapshot
 
 
 class TestDatabase(unittest.TestCase):
@@ -45,6 +62,71 @@ class TestDatabase(unittest.TestCase):
         self.assertFalse(self.db.add_empty_medal(123456))
         self.assertTrue(self.db.check_empty_medal(123456))
 
+    def test_bulk_epic_empty(self):
+        self.assertTrue(self.db.add_epic(1))
+        self.assertTrue(self.db.add_empty_medal(2))
+        self.assertSetEqual(self.db.get_unseen_epics([1, 2, 3, 3]), {2, 3})
+        self.assertSetEqual(self.db.add_epics([1, 2, 3]), {2, 3})
+        self.assertSetEqual(self.db.get_unseen_epics([1, 2, 3]), set())
+        self.assertTrue(self.db.check_epic(3))
+        self.assertSetEqual(self.db.get_unseen_empty_medals(range(1, 4)), {1, 3})
+        self.assertSetEqual(self.db.add_empty_medals([1]), {1})
+        self.assertSetEqual(self.db.add_empty_medals([]), set())
+        self.assertTrue(self.db.check_empty_medal(1))
+
+    def test_division_pruning(self):
+        self.db.add_epics([1, 2, 3])
+        self.db.add_empty_medals([3])
+        now = int(time.time())
+        self.db.touch_divisions([1, 3], now + 3600)
+        self.assertEqual(self.db.prune_divisions(ended_after=900, timestamp=now + 3600), 1)
+        self.assertSetEqual(self.db.get_unseen_epics([1, 2, 3]), {2})
+        self.assertFalse(self.db.get_unseen_empty_medals([3]))
+        self.assertEqual(self.db.prune_divisions(ttl=2 * 3600, timestamp=now + 3 * 3600), 3)
+        self.assertEqual(self.db.division.count, 0)
+
+    def test_division_persistence(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "test.db")
+            db.DiscordDB(db_name).add_epics([1])
+            self.assertTrue(db.DiscordDB(db_name).check_epic(1))
+
+    def test_migrations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, "legacy.db")
+            legacy = sqlite_utils.Database(db_name)
+            legacy.create_table("member", {"name": str, "pm_is_allowed": bool}, pk="id")
+            legacy["member"].insert_all([{"id": 1, "name": "one", "pm_is_allowed": None}, {"id": 2, "name": "two", "pm_is_allowed": True}])
+            legacy.create_table("notification_channel", {"guild_id": int, "channel_id": int, "kind": str}, pk="id")
+            legacy["notification_channel"].insert({"guild_id": 13, "channel_id": 16, "kind": "empty"})
+            legacy.conn.close()
+
+            migrated = db.DiscordDB(db_name)
+            self.assertEqual(migrated.schema_version, len(db.MIGRATIONS))
+            self.assertEqual(migrated.get_member(1), {"id": 1, "name": "one", "pm_is_allowed": 0})
+            self.assertEqual(migrated.get_member(2), {"id": 2, "name": "two", "pm_is_allowed": 1})
+            self.assertListEqual(migrated.get_kind_notification_channel_ids("empty"), [16])
+            self.assertNotIn("notification_channel", migrated._db.table_names())
+            self.assertEqual(db.DiscordDB(db_name)._db["schema_version"].count, len(db.MIGRATIONS))
+
+    def test_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = db.DiscordDB(os.path.join(tmp, "test.db"))._conn
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+            conn.close()
+        self.assertEqual(self.db._conn.execute("PRAGMA journal_mode").fetchone()[0], "memory")
+
+    def test_battle_order(self):
+        self.assertTrue(self.db.set_battle_order(100, 71))
+        self.assertFalse(self.db.set_battle_order(100, 72))
+        self.assertTrue(self.db.set_battle_order(101, 72))
+        self.assertEqual(self.db.get_battle_order(100), {"id": 1, "battle_id": 100, "side": 71})
+        self.assertEqual([row["battle_id"] for row in self.db.get_battle_order()], [100, 101])
+        self.assertTrue(self.db.delete_battle_order(100))
+        self.assertFalse(self.db.delete_battle_order(100))
+        self.assertIsNone(self.db.get_battle_order(100))
+
     def test_rss_feed(self):
         self.assertEqual(self.db.get_rss_feed_timestamp(71), 0.0)
         self.db.set_rss_feed_timestamp(71, 16000000)
@@ -70,6 +152,97 @@ class TestDatabase(unittest.TestCase):
         self.assertFalse(self.db.get_role_id_for_channel_division(kind=kind, channel_id=16, division=5))
         self.assertRaises(RuntimeError, self.db.get_notification_channel_id, "non-existant")
 
+    def test_channel_cache(self):
+        self.assertTrue(self.db.add_notification_channel(13, 16, "epic"))
+        self.assertTrue(self.db.add_notification_channel(13, 17, "epic"))
+        self.assertTrue(self.db.add_notification_channel(13, 16, "empty"))
+        self.assertTrue(self.db.add_role_mapping_entry("epic", 16, 4, 160004))
+        self.assertTrue(self.db.add_role_mapping_entry("empty", 16, 4, 260004))
+        self.assertListEqual(self.db.get_kind_notification_channel_ids("epic"), [16, 17])
+        self.assertEqual(self.db.get_role_id_for_channel_division(kind="empty", channel_id=16, division=4), 260004)
+
+        self.assertTrue(self.db.remove_kind_notification_channel("epic", 16))
+        self.assertListEqual(self.db.get_kind_notification_channel_ids("epic"), [17])
+        self.assertEqual(self.db.get_role_id_for_channel_division(kind="empty", channel_id=16, division=4), 260004)
+        self.assertTrue(self.db.add_notification_channel(13, 16, "epic"))
+        self.assertIsNone(self.db.get_role_id_for_channel_division(kind="epic", channel_id=16, division=4))
+        self.assertEqual(self.db.role_mapping.count, 1)
+
+
+class TestAsyncDatabase(unittest.IsolatedAsyncioTestCase):
+    async def test_batched_writes_and_reads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = async_db.AsyncDiscordDB(os.path.join(directory, "test.db"))
+            try:
+                results = await asyncio.gather(*(database.add_member(member_id, f"Member {member_id}") for member_id in range(1, 51)), database.add_player(1, "dup"))
+                self.assertEqual(results[0], {"id": 1, "name": "Member 1", "pm_is_allowed": False})
+                self.assertLess(database.batches, 10)
+                self.assertEqual(await database.get_member(50), {"id": 50, "name": "Member 50", "pm_is_allowed": False})
+
+                # A failing write is rolled back alone, the rest of the batch is committed
+                failing = database.add_role_mapping_entry("epic", 999, 4, 400)
+                added = database.add_epics([1, 2, 3])
+                with self.assertRaises(sqlite3.IntegrityError):
+                    await failing
+                self.assertSetEqual(await added, {1, 2, 3})
+                self.assertSetEqual(await database.get_unseen_epics([2, 3, 4]), {4})
+
+                self.assertTrue(await database.add_notification_channel(1, 10, "epic"))
+                await database.add_role_mapping_entry("epic", 10, 4, 400)
+                self.assertListEqual(await database.get_kind_notification_channel_ids("epic"), [10])
+                self.assertEqual(await database.get_role_id_for_channel_division(kind="epic", channel_id=10, division=4), 400)
+                with self.assertRaises(AttributeError):
+                    database.drop_everything
+            finally:
+                database.close()
+            self.assertEqual(sqlite_utils.Database(os.path.join(directory, "test.db")).journal_mode, "wal")
+
+    async def test_notification_cache_follows_commits(self):
+        database = async_db.AsyncDiscordDB(":memory:")
+        try:
+            add_notification_channel = database._writer_db.add_notification_channel
+
+            def add_and_fail(guild_id, channel_id, kind):
+                add_notification_channel(guild_id, channel_id, kind)
+                raise ValueError("failed after the insert")
+
+            database._writer_db.add_notification_channel = add_and_fail
+            failing = database.add_notification_channel(1, 20, "epic")
+            with self.assertRaises(ValueError):
+                await failing
+            self.assertListEqual(await database.get_kind_notification_channel_ids("epic"), [])
+
+            del database._writer_db.add_notification_channel
+            self.assertTrue(await database.add_notification_channel(1, 21, "epic"))
+            self.assertListEqual(await database.get_kind_notification_channel_ids("epic"), [21])
+        finally:
+            database.close()
+
+    async def test_writer_survives_failed_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.db")
+            with mock.patch.object(async_db, "connect", functools.partial(async_db.connect, timeout=0)):
+                database = async_db.AsyncDiscordDB(path)
+            locker = sqlite3.connect(path)
+            try:
+                locker.execute("BEGIN IMMEDIATE")
+                with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                    await asyncio.wait_for(database.add_member(1, "Member"), 5)
+                locker.rollback()
+                self.assertEqual((await asyncio.wait_for(database.add_member(2, "Member"), 5))["id"], 2)
+                self.assertTrue(database._writer.is_alive())
+            finally:
+                locker.close()
+                database.close()
+
+    async def test_in_memory(self):
+        database = async_db.AsyncDiscordDB(":memory:")
+        try:
+            await database.add_member(1, "Member")
+            self.assertEqual((await database.get_member(1))["name"], "Member")
+        finally:
+            database.close()
+
 
 class TestRegexes(unittest.TestCase):
     def test_events(self):
@@ -80,6 +253,538 @@ class TestRegexes(unittest.TestCase):
             self.assertTrue(isinstance(event.regex, re.Pattern))
             self.assertTrue(event.format)
 
+    def test_classifier_matches_linear_scan(self):
+        event_classifier = classifier.EventClassifier(constants.events)
+        keywords = [classifier.required_literal(event.regex) for event in constants.events]
+        messages = benchmark.SAMPLE_MESSAGES + [f"Latvia{a}Russia{b}Estonia" for a in keywords for b in keywords[::7]]
+        for msg in messages:
+            self.assertEqual(event_classifier.classify(msg), benchmark.linear_classify(msg), msg)
+
+
+class TestFetcher(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        async def handler(request):
+            self.requests.append(dict(request.headers))
+            if request.headers.get("If-None-Match") == '"v1"':
+                return web.Response(status=304)
+            return web.Response(body=b'{"battles": {}}', headers={"ETag": '"v1"'})
+
+        app = web.Application()
+        app.router.add_get("/campaigns", handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/campaigns"
+        self.fetcher = fetcher.Fetcher(timeout=5)
+
+    async def asyncTearDown(self):
+        await self.fetcher.close()
+        await self.runner.cleanup()
+
+    async def test_conditional_get(self):
+        first = await self.fetcher.get(self.url)
+        self.assertFalse(first.not_modified)
+        self.assertEqual(first.body, b'{"battles": {}}')
+        second = await self.fetcher.get(self.url)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(self.requests[1].get("If-None-Match"), '"v1"')
+        self.assertNotIn("If-None-Match", self.requests[0])
+        self.fetcher.forget(self.url)
+        self.assertFalse((await self.fetcher.get(self.url)).not_modified)
+        self.assertNotIn("If-None-Match", self.requests[2])
+
+    async def test_conditional_get_without_body(self):
+        self.assertFalse((await self.fetcher.get(self.url, keep_body=False)).not_modified)
+        self.assertNotIn(self.url, self.fetcher._bodies)
+        second = await self.fetcher.get(self.url, keep_body=False)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(second.body, b"")
+        self.assertFalse((await self.fetcher.get(self.url, conditional=False, keep_body=False)).not_modified)
+
+
+class TestFeedParser(unittest.TestCase):
+    def setUp(self):
+        self.newest = 1600000000
+        self.feed = benchmark.synthetic_feed(benchmark.synthetic_messages(20), self.newest, interval=60)
+
+    def legacy(self, feed: bytes, after: float):
+        import feedparser
+
+        return [(time.mktime(e["published_parsed"]), e["link"], e["summary"]) for e in reversed(feedparser.parse(feed).entries) if time.mktime(e["published_parsed"]) > after]
+
+    def test_matches_feedparser(self):
+        for after in (0, self.newest - 1, self.newest - 5 * 60 - 1, self.newest):
+            entries = rss.new_feed_entries(self.feed, after)
+            self.assertListEqual([(entry.timestamp, entry.link, entry.summary) for entry in entries], self.legacy(self.feed, after))
+        self.assertEqual(len(rss.new_feed_entries(self.feed, self.newest - 5 * 60 - 1)), 6)
+        self.assertEqual(rss.new_feed_entries(self.feed, 0)[-1].unix_timestamp, self.newest)
+
+    def test_stops_at_watermark(self):
+        # Everything after the first old entry is never read
+        truncated = self.feed[: self.feed.index(b"</item>", self.feed.index(b"</item>") + 1) + len(b"</item>")] + b"<item><broken"
+        with self.assertRaises(ElementTree.ParseError):
+            list(rss.iter_feed_entries(truncated))
+        with mock.patch.object(rss, "_feedparser_entries") as fallback:
+            self.assertEqual(len(rss.new_feed_entries(truncated, self.newest - 1)), 1)
+        fallback.assert_not_called()
+
+    def test_feedparser_fallback(self):
+        markup = benchmark.synthetic_feed(['A Resource Concession law to <b>Latvia</b> <a href="/en/main/law/Poland/1">has been accepted</a>'], self.newest)
+        malformed = self.feed.replace(b"</channel>", b"&nbsp;</channel>")
+        for feed in (markup, malformed):
+            entries = rss.new_feed_entries(feed, 0)
+            self.assertTrue(entries)
+            self.assertListEqual([(entry.timestamp, entry.link, entry.summary) for entry in entries], self.legacy(feed, 0))
+
+
+class TestRssScheduler(unittest.TestCase):
+    def test_intervals_within_budget(self):
+        countries = range(1, 75)
+        scheduler = rss.RssScheduler(countries, budget=8 / 60, now=0)
+        self.assertListEqual(scheduler.due(0), list(countries))
+        self.assertEqual(scheduler.due(1), [])
+        scheduler.record(71, [1000 - n * 60 for n in range(10)], 1000)
+        scheduler.due(1000)
+        intervals = {country_id: scheduler.interval(country_id, 1000) for country_id in countries}
+        self.assertEqual(min(intervals.values()), intervals[71])
+        self.assertLess(intervals[71], 300)
+        self.assertGreater(intervals[1], intervals[71] * 2)
+        self.assertAlmostEqual(sum(1 / interval for interval in intervals.values()), 8 / 60)
+        self.assertLessEqual(scheduler.next_due(), 1000 + intervals[71] * 1.1)
+
+    def test_fewer_requests_and_lower_latency(self):
+        """Simulated 12 hours with events in three countries against polling every country every 5 minutes"""
+        rnd = random.Random(0)
+        countries, horizon = list(range(1, 75)), 12 * 3600
+        events = {country_id: [] for country_id in countries}
+        for country_id, per_hour in ((71, 12), (35, 6), (41, 3)):
+            ts = rnd.expovariate(per_hour / 3600)
+            while ts < horizon:
+                events[country_id].append(ts)
+                ts += rnd.expovariate(per_hour / 3600)
+        fixed_delays = [(ts // 300 + 1) * 300 - ts for timestamps in events.values() for ts in timestamps]
+
+        scheduler = rss.RssScheduler(countries, budget=8 / 60, now=0)
+        requests, delays, polled = 0, [], dict.fromkeys(countries, 0)
+        while scheduler.next_due() < horizon:
+            now = scheduler.next_due()
+            for country_id in scheduler.due(now):
+                new = [ts for ts in events[country_id] if polled[country_id] < ts <= now]
+                requests += 1
+                delays.extend(now - ts for ts in new)
+                polled[country_id] = now
+                scheduler.record(country_id, new, now)
+        self.assertLess(requests, horizon / 300 * len(countries) * 0.6)
+        self.assertLess(sum(delays) / len(delays), sum(fixed_delays) / len(fixed_delays) / 2)
+
+
+class TestRssPoller(unittest.IsolatedAsyncioTestCase):
+    async def test_bounded_concurrency(self):
+        in_flight = []
+
+        class FakeFetcher:
+            active = 0
+
+            async def get(self, url):
+                self.active += 1
+                in_flight.append(self.active)
+                await asyncio.sleep(0.01)
+                self.active -= 1
+                if "Latvia" in url:
+                    raise ValueError(url)
+                return fetcher.FetchResult(url, 200, b"", False)
+
+        poller = rss.RssPoller(FakeFetcher(), concurrency=3, per_host=2, host_delay=0)
+        results = {country.id: response async for country, response in poller.poll(constants.COUNTRIES.values())}
+        self.assertEqual(set(results), set(constants.COUNTRIES))
+        self.assertIsInstance(results[71], ValueError)
+        self.assertLessEqual(max(in_flight), 2)
+
+    async def test_feed_cache(self):
+        bodies = [(b"v1", False), (b"v1", False), (b"v1", True), (b"v2", False), (b"v2", False), (b"v2", False)]
+        forgotten = []
+
+        class FakeFetcher:
+            async def get(self, url):
+                body, not_modified = bodies.pop(0)
+                return fetcher.FetchResult(url, 304 if not_modified else 200, body, not_modified)
+
+            def forget(self, url):
+                forgotten.append(url)
+
+        poller = rss.RssPoller(FakeFetcher(), host_delay=0)
+        latvia = constants.COUNTRIES[71]
+        results = []
+        # Processing of the first v2 fails, so the same content is returned again
+        for processed in (True, True, True, False, True, True):
+            results.extend([response async for _, response in poller.poll([latvia])])
+            if processed:
+                poller.processed(latvia)
+            else:
+                poller.failed(latvia)
+        self.assertListEqual([result.not_modified for result in results], [False, True, True, False, False, True])
+        self.assertEqual(results[4].body, b"v2")
+        self.assertListEqual(forgotten, [rss.rss_link(latvia)])
+        self.assertEqual(poller.cache.hits[71], 3)
+        self.assertEqual(poller.cache.misses[71], 3)
+        self.assertEqual(metrics.RSS_CACHE_REQUESTS.get(country=71, result="hit"), 3)
+
+
+class TestColumnarSnapshot(unittest.TestCase):
+    def test_matches_legacy_check_battles(self):
+        now = int(time.time())
+        battle_json = benchmark.synthetic_battles(200, now)
+        expected = [(kind, div, copy.deepcopy(data)) for kind, div, data in benchmark.legacy_check_battles(battle_json, now)]
+        self.assertListEqual(list(snapshot.ColumnarSnapshot(battle_json, now).events()), expected)
+
+        div_ids = {data["div_id"] for _, _, data in expected[::3]}
+        subset = [event for event in expected if event[2]["div_id"] in div_ids]
+        self.assertListEqual(list(snapshot.ColumnarSnapshot(battle_json, now).events(div_ids)), subset)
+
+    def test_parse_campaigns(self):
+        now = int(time.time())
+        body = benchmark.synthetic_campaigns(50, now)
+        compact = snapshot.parse_campaigns(body)
+        self.assertSetEqual(set(compact), {"battles", "last_updated"})
+        battle = next(iter(compact["battles"].values()))
+        self.assertSetEqual(set(battle), set(snapshot.BATTLE_FIELDS))
+        division = next(iter(battle["div"].values()))
+        self.assertSetEqual(set(division), set(snapshot.DIVISION_FIELDS))
+        self.assertSetEqual(set(division["wall"]), {"for", "dom"})
+        full = json.loads(body)
+        self.assertListEqual(list(snapshot.ColumnarSnapshot(compact["battles"], now).events()), list(snapshot.ColumnarSnapshot(full["battles"], now).events()))
+
+    def test_empty_snapshot(self):
+        self.assertListEqual(list(snapshot.ColumnarSnapshot({}, int(time.time())).events(set())), [])
+
+
+class TestEmptyMedalIndex(unittest.TestCase):
+    def test_matches_full_scan(self):
+        now = int(time.time())
+        snapshot_ = snapshot.ColumnarSnapshot(benchmark.synthetic_battles(300, now), now)
+        index = snapshot.EmptyMedalIndex(snapshot_)
+        query_now = now + 90
+        later = snapshot.ColumnarSnapshot(benchmark.synthetic_battles(300, now), query_now)
+        for division in (1, 2, 3, 4, 11):
+            for minutes in (0, 30, 80, 200):
+                expected = [data for kind, div, data in later.events() if kind == "empty" and div == division and data["round_time_s"] >= minutes * 60]
+                self.assertListEqual(index.query(division, minutes * 60, query_now), expected)
+                self.assertEqual(index.count(division, minutes * 60, query_now), len(expected))
+
+        expected = index.query(4, 0, query_now)
+        self.assertGreater(len(expected), 10)
+        pages = [index.query(4, 0, query_now, offset=offset, limit=10) for offset in range(0, len(expected), 10)]
+        self.assertListEqual([data for page in pages for data in page], expected)
+        self.assertListEqual(index.query(5), [])
+
+
+class TestSnapshotDiffer(unittest.TestCase):
+    @staticmethod
+    def battles(start, **divisions):
+        divs = {div_id: dict(id=int(div_id[1:]), div=4, end=None, epic=epic, intensity_scale="local", wall={"for": 71, "dom": dom}) for div_id, (dom, epic) in divisions.items()}
+        return {"1": {"id": 1, "start": start, "inv": {"id": 71}, "def": {"id": 35}, "div": divs}}
+
+    def test_diff(self):
+        now = int(time.time())
+        start = now - 80 * 60
+        differ = snapshot.SnapshotDiffer(85 * 60)
+        delta = differ.diff(self.battles(start, d1=(50, 0), d2=(60, 0)), now)
+        self.assertSetEqual(delta.added, {1, 2})
+        differ.commit()
+
+        now += 60
+        delta = differ.diff(self.battles(start, d1=(50, 0), d2=(60, 2), d3=(50, 0)), now)
+        self.assertEqual(delta, snapshot.SnapshotDelta(added={3}, ended=set(), changed={2}, crossed=set()))
+        # Not committed deltas are repeated
+        self.assertEqual(differ.diff(self.battles(start, d1=(50, 0), d2=(60, 2), d3=(50, 0)), now), delta)
+        differ.commit()
+
+        now += 5 * 60
+        delta = differ.diff(self.battles(start, d1=(50, 0), d3=(50, 0)), now)
+        self.assertEqual(delta, snapshot.SnapshotDelta(added=set(), ended={2}, changed=set(), crossed={1, 3}))
+        self.assertSetEqual(delta.active, {1, 3})
+
+
+class TestDeadlineQueue(unittest.TestCase):
+    def test_coalesce_and_pop(self):
+        queue = deadlines.DeadlineQueue(resolution=5)
+        queue.add_many([1003, 1001, 1005, 1012, 1001])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.next_deadline(), 1005)
+        self.assertListEqual(queue.pop_due(1004.9), [])
+        self.assertListEqual(queue.pop_due(1005), [1005])
+        queue.add(1004)
+        self.assertListEqual(queue.pop_due(2000), [1005, 1015])
+        self.assertIsNone(queue.next_deadline())
+
+    def test_recheck_at_deadline(self):
+        """Re-checking the same snapshot at a round's deadline only scans the divisions of that round"""
+        now = 1600000000
+        battles = TestSnapshotDiffer.battles(now - 84 * 60 - 30, d1=(50, 0), d2=(60, 0))
+        battles["2"] = dict(TestSnapshotDiffer.battles(now - 60 * 60, d3=(50, 0))["1"], id=2)
+        differ = snapshot.SnapshotDiffer(85 * 60)
+        current = snapshot.ColumnarSnapshot(battles, now)
+        differ.diff_snapshot(current)
+        differ.commit()
+        queue = deadlines.DeadlineQueue()
+        queue.add_many(start + 85 * 60 for start in set(current.start.tolist()))
+        deadline = queue.pop_due(now + 30 * 60)[0]
+        self.assertEqual(deadline, now + 30)
+        delta = differ.diff_snapshot(snapshot.ColumnarSnapshot(battles, deadline))
+        self.assertEqual(delta, snapshot.SnapshotDelta(added=set(), ended=set(), changed=set(), crossed={1, 2}))
+
+
+class TestNotificationDispatcher(unittest.IsolatedAsyncioTestCase):
+    async def test_fan_out(self):
+        sent, active, rate_limited = [], [], {2}
+
+        async def send(channel_id, text):
+            active.append(channel_id)
+            await asyncio.sleep(0.01)
+            active.remove(channel_id)
+            if channel_id in rate_limited:
+                rate_limited.remove(channel_id)
+                raise discord.HTTPException(SimpleNamespace(status=429, reason="Too Many Requests", headers={"Retry-After": "0.01"}), "rate limited")
+            if channel_id == 3:
+                raise discord.HTTPException(SimpleNamespace(status=403, reason="Forbidden"), "missing access")
+            self.assertLessEqual(len(active), 2)
+            sent.append((channel_id, text))
+            return text
+
+        dispatcher = dispatch.NotificationDispatcher(send, workers=2)
+        messages = [(channel_id, (f"{channel_id}-{n}",), {}) for n in range(3) for channel_id in (1, 2, 3, 4)]
+        results = await dispatcher.fan_out(messages)
+
+        self.assertEqual(results[0], "1-0")
+        self.assertIsInstance(results[2], discord.HTTPException)
+        self.assertEqual(dispatcher.rate_limited, 1)
+        for channel_id in (1, 2, 4):
+            self.assertListEqual([text for ch, text in sent if ch == channel_id], [f"{channel_id}-{n}" for n in range(3)])
+        self.assertEqual(dispatcher.latency_stats()["count"], 9)
+
+    async def test_backoff_frees_worker(self):
+        sent, rate_limited = [], {1}
+
+        async def send(channel_id, text):
+            if channel_id in rate_limited:
+                rate_limited.remove(channel_id)
+                raise discord.HTTPException(SimpleNamespace(status=429, reason="Too Many Requests", headers={"Retry-After": "0.2"}), "rate limited")
+            sent.append(channel_id)
+
+        dispatcher = dispatch.NotificationDispatcher(send, workers=1)
+        await dispatcher.fan_out([(1, ("a",), {}), (2, ("b",), {}), (3, ("c",), {})])
+        # Healthy channels are sent to while channel 1 waits out its backoff
+        self.assertListEqual(sent, [2, 3, 1])
+
+    async def test_digest(self):
+        sent = []
+
+        async def send(channel_id, *args, **kwargs):
+            sent.append((channel_id, args, kwargs))
+
+        digest = dispatch.DigestBuffer(dispatch.NotificationDispatcher(send), window=0.01)
+        empty = discord.Embed(title="Possibly empty D4 medals").add_field(name="Battle for Vidzeme", value="R1").add_field(name="Battle for Kurzeme", value="R2")
+        digest.add(
+            [
+                (1, ("<@&4> epic battle detected!",), dict(embed=discord.Embed(title="Full Scale", url="https://erep.lv", description="Epic battle"))),
+                (1, ("<@&3> epic battle detected!",), dict(embed=discord.Embed(title="Local", description="Epic battle"))),
+                (1, ("<@&4> empty medals in late rounds!",), dict(embed=empty)),
+                (2, (), dict(embed=empty)),
+            ]
+        )
+        [waiter] = digest.add([(1, (), dict(embed=discord.Embed(title="Cold War", description="Epic battle")))])
+        self.assertFalse(waiter.done())
+        await asyncio.wait_for(waiter, 1)
+
+        self.assertEqual(len(sent), 2)
+        channel_id, args, kwargs = next(message for message in sent if message[0] == 1)
+        self.assertEqual(args, ("<@&4> <@&3>",))
+        self.assertListEqual(
+            [field.name for field in kwargs["embed"].fields],
+            ["Full Scale", "Local", "Possibly empty D4 medals: Battle for Vidzeme", "Possibly empty D4 medals: Battle for Kurzeme", "Cold War"],
+        )
+        self.assertEqual(kwargs["embed"].fields[0].value, "Epic battle\nhttps://erep.lv")
+        self.assertIn((2, (), dict(embed=empty)), sent)
+
+        waiters = digest.add([(3, ("late",), {})])
+        await digest.flush()
+        self.assertTrue(all(waiter.done() for waiter in waiters))
+        self.assertIn((3, ("late",), {}), sent)
+
+    def test_digest_empty_medal_divisions(self):
+        digest = dispatch.DigestBuffer(dispatch.NotificationDispatcher(None))
+        d1 = discord.Embed(title="Possibly empty D1 medals").add_field(name="Battle for Vidzeme", value="[R1 | Time 01:25:00](https://erep.lv/1)")
+        air = discord.Embed(title="Possibly empty Air medals").add_field(name="Battle for Vidzeme", value="[R1 | Time 01:25:10](https://erep.lv/1)")
+        epic = discord.Embed(title="Full Scale", url="https://erep.lv/2", description="Epic battle Latvia vs Russia!\nBattle for Kurzeme, Round 3")
+        [(_, _, kwargs)] = digest.merge(1, [((), dict(embed=d1)), ((), dict(embed=air)), ((), dict(embed=epic))])
+        fields = kwargs["embed"].fields
+        self.assertListEqual([field.name for field in fields[:2]], ["Possibly empty D1 medals: Battle for Vidzeme", "Possibly empty Air medals: Battle for Vidzeme"])
+        self.assertEqual(fields[1].value, "[R1 | Time 01:25:10](https://erep.lv/1)")
+        self.assertEqual(fields[2].value, "Epic battle Latvia vs Russia!\nBattle for Kurzeme, Round 3\nhttps://erep.lv/2")
+
+
+class TestSnapshotProvider(unittest.IsolatedAsyncioTestCase):
+    async def test_singleflight_and_stale(self):
+        calls = []
+
+        async def fetch():
+            calls.append(time.time())
+            await asyncio.sleep(0.01)
+            return dict(n=len(calls))
+
+        page = provider.SnapshotProvider(fetch, expires=lambda value, now: now + 0.05, min_interval=0)
+        results = await asyncio.gather(*(page.get() for _ in range(10)))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+        await asyncio.sleep(0.06)
+        self.assertEqual(await page.get(), dict(n=1))  # stale value while refreshing
+        self.assertEqual(await page.get(allow_stale=False), dict(n=2))
+        self.assertEqual(len(calls), 2)
+
+    async def test_backoff_and_circuit(self):
+        calls = []
+
+        async def fetch():
+            calls.append(time.time())
+            raise ValueError("not json")
+
+        page = provider.SnapshotProvider(fetch, expires=lambda value, now: now, backoff=0.01, failure_threshold=3, cooldown=60)
+        for attempt in range(3):
+            with self.assertRaises(ValueError):
+                await page.get()
+            await asyncio.sleep(0.01 * 2 ** attempt + 0.005)
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(page.circuit_open)
+        with self.assertRaises(provider.SnapshotUnavailable) as ctx:
+            await page.get()
+        self.assertGreater(ctx.exception.retry_at, time.time() + 50)
+        self.assertEqual(len(calls), 3)
+
+
+class TestRecordReplay(unittest.IsolatedAsyncioTestCase):
+    async def test_record_and_replay(self):
+        now = int(time.time())
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = archive.Recorder(directory)
+            recorder.record("rss", 71, b"<rss/>", now + 1.5)
+            recorder.record("campaigns", "list", benchmark.synthetic_campaigns(5, now), now)
+            recorder.record("campaigns", "list", benchmark.synthetic_campaigns(5, now + 60), now + 60)
+            recorder.close()
+            entries = archive.read_archive(recorder.path)
+        self.assertListEqual(
+            [(entry.timestamp, entry.kind, entry.key) for entry in entries], [(now, "campaigns", "list"), (now + 1.5, "rss", "71"), (now + 60, "campaigns", "list")]
+        )
+
+        calls = []
+        transport = replay.FakeTransport()
+
+        class Watchers:
+            digest = None
+
+            async def check_battle_page(self, r, ts):
+                calls.append(("campaigns", ts, len(r["battles"])))
+                await transport.get_channel(1).send("epic", embed=discord.Embed(title="Epic"))
+
+            async def process_rss_feed(self, country, feed):
+                calls.append(("rss", country.id, feed))
+
+        started = time.monotonic()
+        stats = await replay.replay(Watchers(), entries, speed=600)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertListEqual(calls, [("campaigns", now, 5), ("rss", 71, b"<rss/>"), ("campaigns", now + 60, 5)])
+        self.assertEqual(stats["campaigns_ticks"], 2)
+        self.assertEqual(transport.sent[0], replay.SentMessage(1, "epic", transport.sent[0].embed))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_compare(self):
+        baseline = dict(results=dict(check_battles=dict(small=dict(divisions=200, legacy_ms=10.0, columnar_ms=5.0))))
+        results = dict(results=dict(check_battles=dict(small=dict(divisions=400, legacy_ms=11.0, columnar_ms=7.5), huge=dict(columnar_ms=50.0))))
+        self.assertListEqual(benchmark.compare(results, baseline, tolerance=0.2), ["check_battles[small] columnar_ms: 5.000 -> 7.500 (+50%)"])
+        self.assertListEqual(benchmark.compare(results, dict(), tolerance=0.2), [])
+
+    def test_fixture(self):
+        fixture = benchmark.Fixture.synthetic("tiny", 5)
+        self.assertEqual(len(fixture.battle_json), 5)
+        self.assertEqual(len(fixture.messages), 5)
+        self.assertTrue(all(fixture.messages))
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    async def test_render_and_serve(self):
+        registry = metrics.Registry()
+        polls = metrics.Counter("test_polls_total", "Polls", ["source"], registry=registry)
+        latency = metrics.Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1), registry=registry)
+        polls.inc(source="rss")
+        polls.inc(2, source='camp"aigns')
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+        with self.assertRaises(ValueError):
+            polls.inc(channel=1)
+
+        runner = await metrics.serve("127.0.0.1", 0, registry)
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+                    text = await response.text()
+        finally:
+            await runner.cleanup()
+        self.assertIn('# TYPE test_polls_total counter\ntest_polls_total{source="rss"} 1\ntest_polls_total{source="camp\\"aigns"} 2\n', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1\ntest_latency_seconds_bucket{le="1"} 2\ntest_latency_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn("test_latency_seconds_sum 5.55\ntest_latency_seconds_count 3\n", text)
+
+    async def test_instrumentation(self):
+        queries = metrics.DB_QUERY_SECONDS.count(method="get_unseen_epics")
+        database = db.DiscordDB()
+        database.get_unseen_epics([1, 2])
+        self.assertEqual(metrics.DB_QUERY_SECONDS.count(method="get_unseen_epics"), queries + 1)
+
+        # Cache lookups aren't queries, and nested calls are part of the outer call only
+        lookups = metrics.DB_QUERY_SECONDS.count(method="get_kind_notification_channel_ids")
+        added = metrics.DB_QUERY_SECONDS.count(method="add_notification_channel")
+        database.add_notification_channel(1, 10, "epic")
+        database.get_kind_notification_channel_ids("epic")
+        self.assertEqual(metrics.DB_QUERY_SECONDS.count(method="get_kind_notification_channel_ids"), lookups)
+        self.assertEqual(metrics.DB_QUERY_SECONDS.count(method="add_notification_channel"), added + 1)
+
+        async def send(channel_id, *args, **kwargs):
+            if channel_id == 2:
+                raise LookupError(channel_id)
+
+        await dispatch.NotificationDispatcher(send).fan_out([(1, ("a",), {}), (2, ("b",), {})])
+        self.assertGreaterEqual(metrics.SEND_SECONDS.count(channel=1), 1)
+        self.assertGreaterEqual(metrics.SEND_FAILURES.get(channel=2), 1)
+
+
+class TestLoopMonitor(unittest.IsolatedAsyncioTestCase):
+    async def test_stall_capture(self):
+        def blocking_call():
+            time.sleep(0.3)
+
+        monitor = loop_monitor.LoopMonitor(interval=0.01, threshold=0.1, capacity=2)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+            for _ in range(3):
+                blocking_call()
+                await asyncio.sleep(0.05)
+        finally:
+            monitor.stop()
+
+        self.assertEqual(len(monitor.stalls), 2)
+        stall = monitor.recent_stalls(1)[0]
+        self.assertTrue(stall.finished)
+        self.assertGreaterEqual(stall.duration, 0.25)
+        self.assertIn("blocking_call", stall.stack[-1])
+        self.assertGreaterEqual(monitor.lag_stats()["max"], 0.25)
+
 
 if __name__ == "__main__":
     unittest.main()
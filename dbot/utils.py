@@ -1,15 +1,15 @@
+import asyncio
 import datetime
 from json import JSONDecodeError
-from operator import itemgetter
-from typing import Any, Dict, Generator, Tuple, Union
+from typing import Any, Collection, Dict, Generator, Optional, Tuple
 
-import requests as requests
+from dbot.base import HTTP, RECORDER, logger
+from dbot.constants import DivisionData
+from dbot.metrics import POLL_FAILURES, POLL_PAYLOAD_BYTES, POLL_SECONDS
+from dbot.provider import SnapshotProvider
+from dbot.snapshot import ColumnarSnapshot, EmptyMedalIndex, parse_campaigns
 
-from dbot.base import logger
-from dbot.constants import UTF_FLAG, DivisionData
-
-LAST_BATTLE_RESPONSE = None
-LAST_BATTLE_UPDATE_TIMESTAMP = 0
+CAMPAIGNS_URL = "https://www.erepublik.com/en/military/campaignsJson/list"
 
 
 def timestamp_to_datetime(ts: int) -> datetime.datetime:
@@ -20,67 +20,62 @@ def timestamp() -> int:
     return int(datetime.datetime.now().timestamp())
 
 
-def s_to_human(seconds: Union[int, float]) -> str:
-    seconds = int(seconds)
-    h = seconds // 3600
-    m = (seconds - (h * 3600)) // 60
-    s = seconds % 60
-    return f"{h:01d}:{m:02d}:{s:02d}"
-
-
-def check_battles(battle_json: Dict[str, Dict[str, Any]]) -> Generator[Tuple[str, int, DivisionData], None, None]:
-    for battle in sorted(battle_json.values(), key=itemgetter("start")):
-        if battle["start"] > timestamp():
-            continue
-        region_name = battle["region"]["name"]
-        invader_flag = UTF_FLAG[battle["inv"]["id"]]
-        defender_flag = UTF_FLAG[battle["def"]["id"]]
-        for div in battle["div"].values():
-            if div["end"]:
-                continue
-            division = div["div"]
-            dom = div["wall"]["dom"]
-            epic = div["epic"]
-            division_meta_data = DivisionData(
-                region=region_name,
-                round_time=s_to_human(timestamp() - battle["start"]),
-                round_time_s=int(timestamp() - battle["start"]),
-                sides=[],
-                url=f"https://www.erepublik.com/en/military/battlefield/{battle['id']}",
-                zone_id=battle["zone_id"],
-                div_id=div["id"],
-                extra={},
-            )
-            if dom == 50:
-                division_meta_data.update(sides=[invader_flag, defender_flag])
-                yield "empty", division, division_meta_data
-                division_meta_data["sides"].clear()
-            if dom == 100:
-                division_meta_data.update(sides=[invader_flag if battle["def"]["id"] == div["wall"]["for"] else defender_flag])
-                yield "empty", division, division_meta_data
-                division_meta_data["sides"].clear()
-            if epic > 1:
-                division_meta_data.update(sides=[invader_flag, defender_flag])
-                division_meta_data["extra"].update(intensity_scale=div["intensity_scale"], epic_type=epic)
-                yield "epic", division, division_meta_data
-                division_meta_data["sides"].clear()
-                division_meta_data["extra"].clear()
-            if dom >= 66.8:
-                division_meta_data.update(sides=[invader_flag if battle["def"]["id"] == div["wall"]["for"] else defender_flag])
-                yield "steal", division, division_meta_data
-                division_meta_data["sides"].clear()
-    return
-
-
-def get_battle_page():
-    global LAST_BATTLE_UPDATE_TIMESTAMP, LAST_BATTLE_RESPONSE
-    if int(datetime.datetime.now().timestamp()) >= LAST_BATTLE_UPDATE_TIMESTAMP + 60:
-        dt = datetime.datetime.now()
-        r = requests.get("https://www.erepublik.com/en/military/campaignsJson/list")
-        try:
-            LAST_BATTLE_RESPONSE = r.json()
-        except JSONDecodeError:
-            logger.warning("Received non json response from erep.lv/battles.json!")
-            return get_battle_page()
-        LAST_BATTLE_UPDATE_TIMESTAMP = LAST_BATTLE_RESPONSE.get("last_updated", int(dt.timestamp()))
-    return LAST_BATTLE_RESPONSE
+def check_battles(battle_json: Dict[str, Dict[str, Any]], div_ids: Optional[Collection[int]] = None) -> Generator[Tuple[str, int, DivisionData], None, None]:
+    """Yield (kind, division, data) for every notable division
+
+    :param battle_json: campaignsJson battles
+    :param div_ids: Only check these division IDs, eg. the active ones from SnapshotDiffer delta
+    """
+    return ColumnarSnapshot(battle_json, timestamp()).events(div_ids)
+
+
+async def _fetch_battle_page() -> Dict[str, Any]:
+    # The parsed snapshot is kept instead of the raw body, so only ask for a 304 while there is one
+    previous = BATTLE_PAGE.value
+    try:
+        with POLL_SECONDS.time(source="campaigns"):
+            r = await HTTP.get(CAMPAIGNS_URL, conditional=previous is not None, keep_body=False)
+    except Exception:
+        POLL_FAILURES.inc(source="campaigns")
+        raise
+    if r.not_modified and previous is not None:
+        return previous
+    POLL_PAYLOAD_BYTES.observe(len(r.body), source="campaigns")
+    if RECORDER is not None:
+        RECORDER.record("campaigns", "list", r.body)
+    try:
+        # Parsing a large response takes a few hundred ms, the loop gets the GIL back between the decoder's callbacks
+        return await asyncio.get_event_loop().run_in_executor(None, parse_campaigns, r.body)
+    except JSONDecodeError:
+        HTTP.forget(CAMPAIGNS_URL)
+        logger.warning("Received non json response from erep.lv/battles.json!")
+        raise
+
+
+BATTLE_PAGE: SnapshotProvider[Dict[str, Any]] = SnapshotProvider(
+    _fetch_battle_page, expires=lambda page, fetched_at: page.get("last_updated", fetched_at) + 60, name="campaignsJson"
+)
+
+
+async def get_battle_page(allow_stale: bool = True) -> Dict[str, Any]:
+    """Get latest campaignsJson battles
+
+    :param allow_stale: Serve the last good snapshot while a refresh is running
+    :raises SnapshotUnavailable: if there is no snapshot to serve and fetching is backing off
+    """
+    return await BATTLE_PAGE.get(allow_stale)
+
+
+_EMPTY_MEDAL_INDEX: Tuple[Optional[Dict[str, Any]], Optional[EmptyMedalIndex]] = (None, None)
+
+
+async def get_empty_medal_index() -> EmptyMedalIndex:
+    """Empty medal index of the latest campaignsJson, built once per snapshot"""
+    global _EMPTY_MEDAL_INDEX
+    page = await get_battle_page()
+    indexed_page, index = _EMPTY_MEDAL_INDEX
+    if page is not indexed_page or index is None:
+        battles = page.get("battles") if isinstance(page.get("battles"), dict) else {}
+        index = EmptyMedalIndex(ColumnarSnapshot(battles, page.get("last_updated") or timestamp()))
+        _EMPTY_MEDAL_INDEX = (page, index)
+    return index